@@ -1,36 +1,67 @@
-from sys import argv
-from time import sleep
-from typing import Iterable, NewType, Callable
+import argparse
+import asyncio
+import json
+import re
+import sys
+from time import sleep, monotonic
+from typing import Iterable, Iterator, NewType, Callable, ContextManager
+from collections import deque
+from functools import partial
+from itertools import count
 from dataclasses import dataclass, field
 from pathlib import Path
-from enum import Enum, auto
+from contextlib import nullcontext
+from io import StringIO
+from struct import Struct, error as StructError
+from array import array
+from mmap import mmap, ACCESS_READ
+from os import SEEK_END, replace
+from operator import lt, gt, le, ge, eq, ne
+from enum import Enum, IntEnum, auto
 
 DEBUG = False
 
 """
 TODO: 
-- ALlow for multiple register sets
 - Feature to add line numbers
-- MMU to translate addresses
-- History feature - go back in time
 - Program to insert line numbers
 - Configuration
 
 Next Version
-- Assembler
-- All memory is integers
 - Meta compiler: Use dictionaries to store rules
-- Label table
 """
 
 EXT_SUCCESS = 0
 EXT_ERR_BAD_ARGUMENTS = 1
 EXT_ERR_NOT_A_FILE = 2
 EXT_ERR_SCAN_ERROR = 3 
+EXT_ERR_LIMIT = 4 # stopped by --max-steps or --timeout
 
 ERROR = False
 
 SKIP_TIME = .3 # seconds
+TICKS_PER_SECOND = 1_000_000 # resolution of the virtual clock
+SKIP_TICKS = int(SKIP_TIME * TICKS_PER_SECOND)
+# How SKIP passes time. real sleeps, simulated only advances the virtual
+# clock, and async suspends the machine so VM.run_async can await instead.
+# The async clock also suspends after PRINT, DUMP and file backed disk I/O.
+CLOCKS = ("real", "simulated", "async")
+SUSPENDED = 2 # halt status of a machine suspended by the async clock
+
+
+class AsmError(Exception):
+	# Raised by Memory.error for scan, parse and runtime errors in a program.
+	# source is the text of the line, when it is known.
+	def __init__(self, msg: str, line: int, source: str|None = None):
+		super().__init__(msg)
+		self.msg = msg
+		self.line = line
+		self.source = source
+
+	def __str__(self):
+		if self.source:
+			return f"Line {self.line}: {self.msg}\n\t{self.source}"
+		return f"Line {self.line}: {self.msg}"
 
 
 
@@ -76,6 +107,21 @@ class TokenType(Enum):
 	PRINT = auto()
 	DUMP = auto()
 
+	CAS = auto()
+	FAA = auto()
+	CPUID = auto()
+
+	MCOPY = auto()
+	MFILL = auto()
+	MSUM = auto()
+	MCMP = auto()
+	DCOPY = auto()
+	DFILL = auto()
+	DSUM = auto()
+	DCMP = auto()
+	BREAD = auto()
+	BWRITE = auto()
+
 	EOF = auto()
 	EOL = auto()
 
@@ -101,78 +147,844 @@ KEYWORDS = {
 	"SKIP": TokenType.SKIP,
 	"PRINT": TokenType.PRINT,
 	"DUMP": TokenType.DUMP,
+	"CAS": TokenType.CAS,
+	"FAA": TokenType.FAA,
+	"CPUID": TokenType.CPUID,
+	"MCOPY": TokenType.MCOPY,
+	"MFILL": TokenType.MFILL,
+	"MSUM": TokenType.MSUM,
+	"MCMP": TokenType.MCMP,
+	"DCOPY": TokenType.DCOPY,
+	"DFILL": TokenType.DFILL,
+	"DSUM": TokenType.DSUM,
+	"DCMP": TokenType.DCMP,
+	"BREAD": TokenType.BREAD,
+	"BWRITE": TokenType.BWRITE,
 }
 
 
+class Opcode(IntEnum):
+	NOP = 0 # Blank lines, comments and data
+	LABEL = auto()
+
+	LOAD = auto()
+	STORE = auto()
+
+	READ = auto()
+	WRITE = auto()
+
+	ADD = auto()
+	SUB = auto()
+	MUL = auto()
+	DIV = auto()
+	INC = auto()
+
+	BR = auto()
+	BLT = auto()
+	BGT = auto()
+	BLEQ = auto()
+	BGEQ = auto()
+	BEQ = auto()
+	BNEQ = auto()
+
+	HALT = auto()
+	SKIP = auto()
+
+	PRINT = auto()
+	DUMP = auto()
+
+	# Atomic memory operations and the CPU's number, for SMP programs
+	CAS = auto()
+	FAA = auto()
+	CPUID = auto()
+
+	# Block instructions on count words starting at the addresses in ri
+	# and rj, see Memory.block
+	MCOPY = auto()
+	MFILL = auto()
+	MSUM = auto()
+	MCMP = auto()
+	DCOPY = auto()
+	DFILL = auto()
+	DSUM = auto()
+	DCMP = auto()
+	BREAD = auto()
+	BWRITE = auto()
+
+
+OPCODES = {
+	token_type: Opcode[name] for name, token_type in KEYWORDS.items()
+}
+
+BLOCK_OPCODES = (
+	Opcode.MCOPY, Opcode.MFILL, Opcode.MSUM, Opcode.MCMP,
+	Opcode.DCOPY, Opcode.DFILL, Opcode.DSUM, Opcode.DCMP,
+	Opcode.BREAD, Opcode.BWRITE,
+)
+BLOCK_RESULTS = (Opcode.MSUM, Opcode.MCMP, Opcode.DSUM, Opcode.DCMP) # leave their result in ri
+BLOCK_MEMORY_WRITES = (Opcode.MCOPY, Opcode.MFILL, Opcode.BREAD) # write count words from ri
+
+BINARY_BRANCHES = {
+	Opcode.BLT: "<",
+	Opcode.BGT: ">",
+	Opcode.BLEQ: "<=",
+	Opcode.BGEQ: ">=",
+	Opcode.BEQ: "==",
+	Opcode.BNEQ: "!=",
+}
+
+
+class Mode(IntEnum):
+	NONE = 0
+	DIRECT = auto()    # Addr
+	IMMEDIATE = auto() # =Num
+	INDEX = auto()     # [Addr, Rj]
+	INDIRECT = auto()  # @Addr
+	RELATIVE = auto()  # $Num
+	REGISTER = auto()  # Rk, a block instruction's count
+
+
+LOAD_MODES = (Mode.DIRECT, Mode.IMMEDIATE, Mode.INDEX, Mode.INDIRECT, Mode.RELATIVE)
+STORE_MODES = (Mode.DIRECT, Mode.INDEX, Mode.RELATIVE)
+DISK_MODES = (Mode.DIRECT, Mode.INDEX)
+CAS_MODES = (Mode.DIRECT, Mode.RELATIVE) # rj is taken by the new value
+COUNT_MODES = (Mode.IMMEDIATE, Mode.REGISTER) # operand is the count, or the count's register slot
+
+
+def forms(modes: tuple[Mode, ...], registers: int) -> dict[Mode, int]:
+	# INDEX addressing takes rj as well
+	return {mode: registers + (mode == Mode.INDEX) for mode in modes}
+
+
+# For every opcode the modes its words can have, and how many of ri and
+# rj each mode needs. decode_instruction rejects any other word.
+INSTRUCTION_FORMS = {
+	Opcode.LABEL: forms((Mode.NONE,), 0),
+	Opcode.LOAD: forms(LOAD_MODES, 1),
+	Opcode.STORE: forms(STORE_MODES, 1),
+	Opcode.READ: forms(DISK_MODES, 1),
+	Opcode.WRITE: forms(DISK_MODES, 1),
+	Opcode.ADD: forms((Mode.NONE,), 2),
+	Opcode.SUB: forms((Mode.NONE,), 2),
+	Opcode.MUL: forms((Mode.NONE,), 2),
+	Opcode.DIV: forms((Mode.NONE,), 2),
+	Opcode.INC: forms((Mode.NONE,), 1),
+	Opcode.BR: forms((Mode.NONE,), 0),
+	Opcode.HALT: forms((Mode.NONE,), 0),
+	Opcode.SKIP: forms((Mode.NONE,), 0),
+	Opcode.PRINT: {Mode.NONE: 1, Mode.DIRECT: 0},
+	Opcode.DUMP: forms((Mode.NONE,), 0),
+	Opcode.CAS: forms(CAS_MODES, 2),
+	Opcode.FAA: forms(STORE_MODES, 1),
+	Opcode.CPUID: forms((Mode.NONE,), 1),
+	**{opcode: forms((Mode.NONE,), 2) for opcode in BINARY_BRANCHES},
+	**{opcode: forms(COUNT_MODES, 2) for opcode in BLOCK_OPCODES},
+}
+
+
+@dataclass
+class Instruction:
+	opcode: Opcode
+	ri: int|None = None # Register file slots
+	rj: int|None = None
+	mode: Mode = Mode.NONE
+	operand: int = 0
+	label: str|None = None
+
+
+# Instructions are encoded into one 64 bit word:
+#   opcode (bits 56-62) | mode (52-55) | ri (48-51) | rj (44-47) | operand (0-43)
+# Register fields hold the register's slot plus one so that 0 means "no
+# register". A word whose opcode is NOP is plain data and holds its value in
+# the whole word.
+REGISTERS = ("R1", "R2", "R3", "R4", "R5", "R6")
+REGISTER_NUMBERS = {register: i for i, register in enumerate(REGISTERS)}
+
+OPCODE_SHIFT = 56
+MODE_SHIFT = 52
+RI_SHIFT = 48
+RJ_SHIFT = 44
+OPERAND_MASK = (1 << RJ_SHIFT) - 1
+FIELD_MASK = 0xF
+
+
+def encode_instruction(instruction: Instruction) -> int:
+	if instruction.opcode == Opcode.NOP:
+		# Data is stored as a signed 64 bit word
+		if not -(1 << 63) <= instruction.operand < 1 << 63:
+			raise ValueError(f"Value {instruction.operand} out of range")
+		return instruction.operand
+	if not 0 <= instruction.operand <= OPERAND_MASK:
+		raise ValueError(f"Operand {instruction.operand} out of range")
+	return (
+		instruction.opcode << OPCODE_SHIFT
+		| instruction.mode << MODE_SHIFT
+		| (0 if instruction.ri is None else instruction.ri + 1) << RI_SHIFT
+		| (0 if instruction.rj is None else instruction.rj + 1) << RJ_SHIFT
+		| instruction.operand
+	)
+
+
+def decode_instruction(word: int) -> Instruction:
+	opcode = Opcode(word >> OPCODE_SHIFT)
+	if opcode == Opcode.NOP:
+		return Instruction(opcode, operand=word)
+	ri = (word >> RI_SHIFT) & FIELD_MASK
+	rj = (word >> RJ_SHIFT) & FIELD_MASK
+	mode = Mode((word >> MODE_SHIFT) & FIELD_MASK)
+	operand = word & OPERAND_MASK
+	registers = INSTRUCTION_FORMS[opcode].get(mode)
+	if registers is None:
+		raise ValueError(f"{opcode.name} can't have {mode.name} addressing")
+	if ri > len(REGISTERS) or rj > len(REGISTERS) or (mode == Mode.REGISTER and operand >= len(REGISTERS)):
+		raise ValueError(f"{opcode.name} names a register that doesn't exist")
+	if (registers >= 1 and not ri) or (registers >= 2 and not rj):
+		raise ValueError(f"{opcode.name} is missing a register")
+	return Instruction(opcode, ri - 1 if ri else None, rj - 1 if rj else None, mode, operand)
+
+
+def disassemble(instruction: Instruction, address: int, labels: dict[int, str]) -> str:
+	# labels maps addresses back to label names
+	opcode = instruction.opcode
+	ri = None if instruction.ri is None else REGISTERS[instruction.ri]
+	rj = None if instruction.rj is None else REGISTERS[instruction.rj]
+	n = instruction.operand
+	match opcode:
+		case Opcode.NOP:
+			return str(n) if n else ""
+		case Opcode.LABEL:
+			return f"{labels.get(address, address)}:"
+		case Opcode.BR:
+			return f"BR {labels.get(n, n)}"
+		case Opcode.HALT | Opcode.SKIP | Opcode.DUMP:
+			return opcode.name
+		case Opcode.INC | Opcode.CPUID:
+			return f"{opcode.name} {ri}"
+		case Opcode.CAS:
+			return f"CAS {ri}, {rj}, {n if instruction.mode == Mode.DIRECT else f'${n}'}"
+		case Opcode.PRINT:
+			return f"PRINT {n}" if instruction.mode == Mode.DIRECT else f"PRINT {ri}"
+		case Opcode.ADD | Opcode.SUB | Opcode.MUL | Opcode.DIV:
+			return f"{opcode.name} {ri}, {rj}"
+	if opcode in BLOCK_OPCODES:
+		return f"{opcode.name} {ri}, {rj}, {REGISTERS[n] if instruction.mode == Mode.REGISTER else f'={n}'}"
+	if opcode in BINARY_BRANCHES:
+		return f"{opcode.name} {ri}, {rj}, {labels.get(n, n)}"
+	match instruction.mode:
+		case Mode.DIRECT:
+			operand = f"{n}"
+		case Mode.IMMEDIATE:
+			operand = f"={n}"
+		case Mode.INDEX:
+			operand = f"[{n}, {rj}]"
+		case Mode.INDIRECT:
+			operand = f"@{n}"
+		case Mode.RELATIVE:
+			operand = f"${n}"
+	return f"{opcode.name} {ri}, {operand}"
+
+
+# Disk files hold native byte order int64 words
+DISK_WORD = array("q")
+
+
+def read_words(storage: array|memoryview, start: int, count: int) -> array:
+	# count words of flat storage, memory or disk, copied
+	if start < 0 or start + count > len(storage):
+		raise IndexError(f"address {start if start < 0 else start + count - 1} out of range")
+	return array(DISK_WORD.typecode, storage[start: start + count])
+
+
+def out_of_range(address: int):
+	# Negative addresses would index storage from its end
+	raise IndexError(f"address {address} out of range")
+
+
+def write_words(storage: array|memoryview, start: int, words: array):
+	# Inverse of read_words
+	if start < 0 or start + len(words) > len(storage):
+		raise IndexError(f"address {start if start < 0 else start + len(words) - 1} out of range")
+	storage[start: start + len(words)] = words
+
+
+# Object file: header, the program's words, then its symbol table
+OBJECT_MAGIC = b"ASMO"
+OBJECT_VERSION = 1
+OBJECT_HEADER = Struct("<4sHII") # magic, version, word count, symbol count
+OBJECT_WORD = Struct("<q")
+OBJECT_SYMBOL = Struct("<IH") # address, name length
+
+
+def is_object_file(path: Path) -> bool:
+	with open(path, "rb") as f:
+		return f.read(len(OBJECT_MAGIC)) == OBJECT_MAGIC
+
+
+def write_object(path: Path, words: list[int], symbols: dict[str, int]):
+	with open(path, "wb") as f:
+		f.write(OBJECT_HEADER.pack(OBJECT_MAGIC, OBJECT_VERSION, len(words), len(symbols)))
+		f.write(b"".join(OBJECT_WORD.pack(word) for word in words))
+		for name, address in symbols.items():
+			encoded = name.encode()
+			f.write(OBJECT_SYMBOL.pack(address, len(encoded)))
+			f.write(encoded)
+
+
+def read_object(path: Path) -> tuple[list[int], dict[str, int]]:
+	with open(path, "rb") as f:
+		data = f.read()
+	try:
+		magic, version, word_count, symbol_count = OBJECT_HEADER.unpack_from(data)
+		if magic != OBJECT_MAGIC or version != OBJECT_VERSION:
+			raise ValueError(f"{path} is not a version {OBJECT_VERSION} object file")
+		offset = OBJECT_HEADER.size
+		if offset + word_count * OBJECT_WORD.size > len(data):
+			raise ValueError(f"{path} is truncated")
+		words = [word for (word,) in OBJECT_WORD.iter_unpack(data[offset: offset + word_count * OBJECT_WORD.size])]
+		offset += word_count * OBJECT_WORD.size
+		symbols = {}
+		for _ in range(symbol_count):
+			address, length = OBJECT_SYMBOL.unpack_from(data, offset)
+			offset += OBJECT_SYMBOL.size
+			symbols[data[offset: offset + length].decode()] = address
+			offset += length
+		return words, symbols
+	except StructError:
+		raise ValueError(f"{path} is truncated") from None
+
+
+class FlatMMU:
+	# Identity mapping onto one contiguous array of words
+	def __init__(self, size: int = 100):
+		self.size = size
+
+	def allocate(self, start: int, words: list[int]|array) -> array:
+		# Grown to fit a program larger than size
+		storage = array("q", [0]) * max(self.size, start + len(words))
+		storage[start: start + len(words)] = array("q", words)
+		return storage
+
+	def ranges(self, storage: array, size: int) -> Iterator[tuple[int, array]]:
+		# (first address, words) for every size words
+		for start in range(0, len(storage), size):
+			yield start, storage[start: start + size]
+
+	def read(self, storage: array, start: int, count: int) -> array:
+		return read_words(storage, start, count)
+
+	def write(self, storage: array, start: int, words: array):
+		# Inverse of ranges and read
+		write_words(storage, start, words)
+
+	def stats(self) -> dict[str, int]:
+		return {}
+
+
+class PagedMMU:
+	# Sparse 32 bit word address space. Virtual page numbers are split into
+	# a page directory index and a page table index; page tables and pages
+	# are only allocated the first time an address inside them is touched
+	# (a page fault). Recent translations are kept in a small FIFO TLB.
+	# PagedMMU is its own storage, so memory.addresses[address] translates.
+	ADDRESS_BITS = 32
+
+	def __init__(self, page_bits: int = 12, tlb_size: int = 16):
+		self.page_bits = page_bits
+		self.page_size = 1 << page_bits
+		self.offset_mask = self.page_size - 1
+		self.table_bits = (self.ADDRESS_BITS - page_bits) // 2
+		self.table_mask = (1 << self.table_bits) - 1
+		self.directory_size = 1 << (self.ADDRESS_BITS - page_bits - self.table_bits)
+		self.tlb_size = tlb_size
+		self.allocate(0, [])
+
+	def allocate(self, start: int, words: list[int]) -> 'PagedMMU':
+		self.directory = [None] * self.directory_size
+		self.tlb = {}
+		for i, word in enumerate(words):
+			self[start + i] = word
+		self.page_faults = 0
+		self.tlb_hits = 0
+		self.tlb_misses = 0
+		return self
+
+	def __translate(self, address: int) -> array:
+		page = address >> self.page_bits
+		tlb = self.tlb
+		if page in tlb:
+			self.tlb_hits += 1
+			return tlb[page]
+		self.tlb_misses += 1
+		if not 0 <= address < 1 << self.ADDRESS_BITS:
+			raise IndexError(f"address {address} out of range")
+		table = self.directory[page >> self.table_bits]
+		if table is None:
+			table = self.directory[page >> self.table_bits] = [None] * (1 << self.table_bits)
+		frame = table[page & self.table_mask]
+		if frame is None:
+			self.page_faults += 1
+			frame = table[page & self.table_mask] = array("q", [0]) * self.page_size
+		if len(tlb) >= self.tlb_size:
+			del tlb[next(iter(tlb))]
+		tlb[page] = frame
+		return frame
+
+	def __getitem__(self, address: int) -> int:
+		return self.__translate(address)[address & self.offset_mask]
+
+	def __setitem__(self, address: int, value: int):
+		self.__translate(address)[address & self.offset_mask] = value
+
+	def ranges(self, storage: 'PagedMMU', size: int) -> Iterator[tuple[int, array]]:
+		# Mapped pages only
+		for d, table in enumerate(self.directory):
+			if table is None:
+				continue
+			for t, frame in enumerate(table):
+				if frame is not None:
+					base = ((d << self.table_bits) | t) << self.page_bits
+					for start in range(0, len(frame), size):
+						yield base + start, frame[start: start + size]
+
+	def read(self, storage: 'PagedMMU', start: int, count: int) -> array:
+		# A page at a time, like write
+		words = array(DISK_WORD.typecode)
+		while len(words) < count:
+			address = start + len(words)
+			offset = address & self.offset_mask
+			words += self.__translate(address)[offset: offset + min(count - len(words), self.page_size - offset)]
+		return words
+
+	def write(self, storage: 'PagedMMU', start: int, words: array):
+		# Inverse of ranges and read, a page at a time
+		done = 0
+		while done < len(words):
+			address = start + done
+			offset = address & self.offset_mask
+			count = min(len(words) - done, self.page_size - offset)
+			self.__translate(address)[offset: offset + count] = words[done: done + count]
+			done += count
+
+	def stats(self) -> dict[str, int]:
+		return {
+			"page_faults": self.page_faults,
+			"tlb_hits": self.tlb_hits,
+			"tlb_misses": self.tlb_misses,
+		}
+
+
+class SourceMap:
+	# Where each source line starts, so error messages can quote the line
+	# without keeping the program's text around. A source file is only
+	# mapped the first time a line is looked up.
+	def __init__(self, source: Path|str, offsets: array):
+		self.source = source
+		self.offsets = offsets
+		self.data = None
+
+	def line(self, number: int) -> str|None:
+		if not 0 <= number < len(self.offsets):
+			return None
+		if self.data is None:
+			if isinstance(self.source, str):
+				self.data = self.source
+			else:
+				with open(self.source, "rb") as f:
+					self.data = mmap(f.fileno(), 0, access=ACCESS_READ)
+		start = self.offsets[number]
+		end = self.offsets[number + 1] if number + 1 < len(self.offsets) else len(self.data)
+		line = self.data[start: end]
+		return (line if isinstance(line, str) else line.decode()).strip()
+
+
+def read_lines(source: Iterable[str|bytes], offsets: array) -> Iterator[str]:
+	# Lines of an open source, noting where each one starts in offsets
+	position = 0
+	for line in source:
+		offsets.append(position)
+		position += len(line)
+		yield line if isinstance(line, str) else line.decode()
+
+
+class Output:
+	# Collects what PRINT and DUMP write and passes it on to sink in large
+	# chunks, when buffer_size characters have built up or when flushed.
+	# sink is anything with write(), None is whatever sys.stdout is then.
+	def __init__(self, sink = None, buffer_size: int = 1 << 16):
+		self.sink = sink
+		self.buffer = []
+		self.size = 0
+		self.buffer_size = buffer_size
+
+	def write(self, text: str):
+		self.buffer.append(text)
+		self.size += len(text)
+		if self.size >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		if self.buffer:
+			(self.sink or sys.stdout).write("".join(self.buffer))
+			self.buffer.clear()
+			self.size = 0
+
+
+DUMP_ROW = 8 # words per line of DUMP
+
+
 @dataclass
 class Memory:
-	registers = {
-		"R1": 0, 
-		"R2": 0, 
-		"R3": 0, 
-		"R4": 0, 
-		"R5": 0, 
-		"R6": 0,
-	}
+	# Word addressed main memory, laid out by the MMU, and disk. With a
+	# disk_file the disk is that file mapped into memory, grown to at least
+	# disk_size words, so it persists between runs.
+	mmu: FlatMMU|PagedMMU = field(default_factory = FlatMMU)
+	disk_size: int = 100
+	disk_file: Path|None = None
+	clock: str = "real" # one of CLOCKS
+	# With SMP, this CPU's number and the lock that makes CAS and FAA atomic
+	cpu: int = 0
+	atomic: ContextManager = field(default_factory = nullcontext)
+	output: Output = field(default_factory = Output)
+	source: SourceMap|None = None # for error messages
+
+	# General purpose registers, indexed by slot (see REGISTER_NUMBERS)
+	registers: list[int] = field(default_factory = lambda: [0] * len(REGISTERS))
 
 	label_table: dict[str, int] = field(default_factory = dict)
 
-	status_registers = {
+	status_registers: dict[str, int] = field(default_factory = lambda: {
 		"ip": 0,
 		"halt": 0,
-		"error": 0
-	}
+		"error": 0,
+		"ticks": 0, # virtual time, advanced by SKIP
+		"cycles": 0, # instructions executed since the program was loaded
+	})
 
 	def error(self, msg: str):
 		self.status_registers["error"] = 1
-		print(f"Line {self.status_registers['ip']}: {msg}")
-		exit(1)
+		line = self.status_registers["ip"]
+		raise AsmError(msg, line, None if self.source is None else self.source.line(line))
 
 	starting_address: int = 0
 
-	def load(self, lines: list[str], size: int = 100):
-		self.disk = [0] * size
-		self.addresses = [0] * size
-		for i, line in enumerate(lines):
-			self.addresses[i+self.starting_address] = line.strip()
-			
-
-	def fde_cycle(self, scanner: 'Scanner', parser: 'Parser'):
-		while self.status_registers["halt"] == 0:
-			instruction = self.fetch()
-			ast = self.decode(instruction, scanner, parser)
-			if ast is None: # halt flag or error parsing halt flag
-				break
-			self.execute(ast)
-			self.status_registers["ip"] += 1 
+	def load(self, words: list[int], symbols: dict[str, int]):
+		# Registers are reset in place because decoded closures hold them
+		self.registers[:] = [0] * len(REGISTERS)
+		self.status_registers.update(ip=0, halt=0, error=0, ticks=0, cycles=0)
+		if self.disk_file is None:
+			self.disk = array("q", [0]) * self.disk_size
+		else:
+			self.disk = self.__map_disk()
+		self.addresses = self.mmu.allocate(self.starting_address, words)
+		self.program_size = len(words)
+		# Decode cache: one closure per code address, filled on first fetch
+		# and cleared by set_val when that address is overwritten. Running
+		# off the end of the program lands on the trailing entry.
+		self.decoded = [None] * self.program_size + [self.__missing_halt]
+		# Filled in by the Optimizer: how many instructions each decoded
+		# closure stands for, and the fused closures that read each address
+		self.weights = None
+		self.fused = {}
+		self.label_table = dict(symbols)
+
+	def __map_disk(self) -> memoryview:
+		with open(self.disk_file, "a+b") as f:
+			f.seek(0, SEEK_END)
+			words = max(self.disk_size, f.tell() // DISK_WORD.itemsize)
+			if f.tell() < words * DISK_WORD.itemsize:
+				f.truncate(words * DISK_WORD.itemsize)
+			self.disk_map = mmap(f.fileno(), words * DISK_WORD.itemsize)
+		return memoryview(self.disk_map).cast(DISK_WORD.typecode)
+
+	def close(self):
+		# Write a mapped disk back to its file and unmap it
+		if self.disk_file is not None and hasattr(self, "disk_map"):
+			self.disk.release()
+			self.disk_map.flush()
+			self.disk_map.close()
+			del self.disk_map
+
+	def share(self, cpu: int, atomic: ContextManager, addresses: array|memoryview, disk: array|memoryview|None = None):
+		# Run as one of several CPUs, against main memory (and disk) owned
+		# by someone else. Code written by another CPU isn't seen by this
+		# one's decode cache.
+		self.cpu = cpu
+		self.atomic = atomic
+		self.addresses = addresses
+		if disk is not None:
+			self.disk = disk
+
+	def __missing_halt(self):
+		self.error("HALT instruction not found")
+
+	def fde_cycle(self, executor: 'Executor', max_steps: int|None = None, profiler: 'Profiler|None' = None, recorder: 'Tracer|History|None' = None) -> int:
+		# Runs until HALT, or until max_steps instructions have executed.
+		# Returns the number of instructions executed, which are also added
+		# to the cycles status register once the loop ends, even if an
+		# instruction fails. The one that failed counts.
+		if profiler is not None:
+			return self.__fde_cycle_profiled(executor, max_steps, profiler)
+		if recorder is not None:
+			return self.__fde_cycle_recorded(executor, max_steps, recorder)
+		if self.weights is not None:
+			return self.__fde_cycle_fused(executor, max_steps)
+		decoded = self.decoded
+		status_registers = self.status_registers
+		steps = 0
+		limit = -1 if max_steps is None else max_steps
+		try:
+			while status_registers["halt"] == 0 and steps != limit:
+				steps += 1
+				ip = status_registers["ip"]
+				address = self.__mmu(ip)
+				ast = decoded[address]
+				if ast is None:
+					ast = executor.build(decode_instruction(self.addresses[address]), ip)
+					decoded[address] = ast
+				ast()
+				status_registers["ip"] += 1 
+		finally:
+			status_registers["cycles"] += steps
+		return steps
+
+	def __fde_cycle_profiled(self, executor: 'Executor', max_steps: int|None, profiler: 'Profiler') -> int:
+		# Same as fde_cycle, also counting executions and jumps per address
+		decoded = self.decoded
+		status_registers = self.status_registers
+		counts = profiler.counts
+		jumps = profiler.jumps
+		steps = 0
+		limit = -1 if max_steps is None else max_steps
+		try:
+			while status_registers["halt"] == 0 and steps != limit:
+				steps += 1
+				ip = status_registers["ip"]
+				address = self.__mmu(ip)
+				ast = decoded[address]
+				if ast is None:
+					ast = executor.build(decode_instruction(self.addresses[address]), ip)
+					decoded[address] = ast
+				counts[address] += 1
+				ast()
+				if status_registers["ip"] != ip:
+					jumps[address] += 1
+				status_registers["ip"] += 1 
+		finally:
+			status_registers["cycles"] += steps
+		return steps
+
+	def __fde_cycle_recorded(self, executor: 'Executor', max_steps: int|None, recorder: 'Tracer|History') -> int:
+		# Same as fde_cycle, handing every step to the recorder. The executor
+		# must share the recorder's journal so memory and disk writes are seen.
+		decoded = self.decoded
+		status_registers = self.status_registers
+		registers = self.registers
+		journal = recorder.journal
+		steps = 0
+		limit = -1 if max_steps is None else max_steps
+		try:
+			while status_registers["halt"] == 0 and steps != limit:
+				steps += 1
+				ip = status_registers["ip"]
+				address = self.__mmu(ip)
+				ast = decoded[address]
+				if ast is None:
+					ast = executor.build(decode_instruction(self.addresses[address]), ip)
+					decoded[address] = ast
+				before = registers[:]
+				journal.clear()
+				ast()
+				recorder.record(ip, self.addresses[address] >> OPCODE_SHIFT, before, registers)
+				status_registers["ip"] += 1 
+		finally:
+			status_registers["cycles"] += steps
+		return steps
+
+	def __fde_cycle_fused(self, executor: 'Executor', max_steps: int|None) -> int:
+		# Same as fde_cycle, counting a fused closure as the instructions it
+		# stands for. One that would go past max_steps is run unfused. Fused
+		# closures can only fail at their first instruction, so one that
+		# fails counts as one step.
+		decoded = self.decoded
+		weights = self.weights
+		status_registers = self.status_registers
+		steps = 0
+		limit = -1 if max_steps is None else max_steps
+		try:
+			while status_registers["halt"] == 0 and steps != limit:
+				ip = status_registers["ip"]
+				address = self.__mmu(ip)
+				steps += 1
+				ast = decoded[address]
+				if ast is None:
+					ast = executor.build(decode_instruction(self.addresses[address]), ip)
+					decoded[address] = ast
+				weight = weights[address]
+				if weight > 1 and limit >= 0 and steps - 1 + weight > limit:
+					ast = executor.build(decode_instruction(self.addresses[address]), ip)
+					weight = 1
+				ast()
+				steps += weight - 1
+				status_registers["ip"] += 1 
+		finally:
+			status_registers["cycles"] += steps
+		return steps
+
+	def predecode(self, executor: 'Executor', selected: Iterable[int]|None = None):
+		# Fill the decode cache for the whole program, or the selected
+		# addresses, ahead of time. Words that aren't valid instructions are
+		# left to fail if they are reached.
+		for address in range(self.program_size) if selected is None else selected:
+			if self.decoded[address] is None:
+				try:
+					instruction = decode_instruction(self.addresses[address])
+				except ValueError:
+					continue
+				self.decoded[address] = executor.build(instruction, address + self.starting_address)
+
+	def checkpoint(self, words: list[int]|array, symbols: dict[str, int]) -> 'Checkpoint':
+		# The machine's state, with the program it was loaded with
+		disk = array(DISK_WORD.typecode)
+		disk.frombytes(self.disk.tobytes())
+		return Checkpoint(
+			array(DISK_WORD.typecode, words),
+			dict(symbols),
+			self.registers[:],
+			dict(self.status_registers),
+			[(start, words) for start, words in self.mmu.ranges(self.addresses, CHECKPOINT_ROW) if any(words)],
+			disk,
+			array("B", [ast is not None for ast in self.decoded[:self.program_size]]),
+		)
+
+	def restore(self, checkpoint: 'Checkpoint'):
+		# Puts back the state of a checkpoint after its program was loaded.
+		# A mapped disk keeps its file but gets the checkpoint's contents.
+		self.registers[:] = checkpoint.registers
+		self.status_registers.update(checkpoint.status_registers)
+		for start, words in checkpoint.segments:
+			self.mmu.write(self.addresses, start, words)
+		if self.disk_file is None:
+			self.disk = checkpoint.disk
+		elif len(checkpoint.disk) > len(self.disk):
+			raise ValueError(f"The checkpoint's disk has {len(checkpoint.disk)} words, {self.disk_file} only {len(self.disk)}")
+		else:
+			self.disk[:len(checkpoint.disk)] = checkpoint.disk
 
 	def fetch(self):
 		return self.addresses[self.__mmu(self.status_registers["ip"])]
 
-	def decode(self, instruction, scanner: 'Scanner', parser: 'Parser'):
-		tokens = scanner.scan_line(instruction)
-		ast = parser.parse(tokens)
-		return ast
+	def resolve_label(self, label: str) -> int:
+		addr = self.label_table.get(label)
+		if addr is None:
+			self.error(f"Parse Error: Label {label} does not exist")
+		return addr
 
 	def execute(self, ast):
 		return ast()
 
-	def __get_register(self, register: str):
-		return self.REGISTERS[register]
+	def get_register(self, register: str) -> int:
+		return self.registers[REGISTER_NUMBERS[register]]
 
 	def set_register(self, register: str, value: int):
-		self.REGISTERS[register] = value
+		self.registers[REGISTER_NUMBERS[register]] = value
+
+	def dump(self):
+		# Memory is written a row at a time, rows of zeros are left out
+		write = self.output.write
+		write(f"Registers: {dict(zip(REGISTERS, self.registers))}\n")
+		write(f"Label Table: {self.label_table}\n")
+		write("Main Memory:\n")
+		for start, words in self.mmu.ranges(self.addresses, DUMP_ROW):
+			if any(words):
+				write(f"{start + self.starting_address}: {' '.join(map(str, words))}\n")
 
 	def __mmu(self, address):
+		if address < self.starting_address:
+			out_of_range(address)
 		return address - self.starting_address
 
 	def get_val(self, address: int):
 		return self.addresses[self.__mmu(address)]
 
-	def set_val(self, address: int, value: str):
-		self.addresses[self.__mmu(address)] = value
-
-@dataclass
+	def set_val(self, address: int, value: int):
+		address = self.__mmu(address)
+		self.addresses[address] = value
+		if 0 <= address < self.program_size:
+			self.__forget(address)
+
+	def __forget(self, address: int):
+		# Code at address was overwritten, drop the closures decoded from it
+		self.decoded[address] = None
+		if address in self.fused:
+			for head in self.fused.pop(address):
+				self.decoded[head] = None
+				self.weights[head] = 1
+
+	def get_vals(self, address: int, count: int) -> array:
+		return self.mmu.read(self.addresses, self.__mmu(address), count)
+
+	def set_vals(self, address: int, words: array, journal: list|None = None):
+		# Same as set_val for count words, journaled like the Executor does
+		if journal is not None:
+			old = self.get_vals(address, len(words))
+			journal.extend((WRITE_MEMORY, address + i, old[i], word) for i, word in enumerate(words))
+		start = self.__mmu(address)
+		self.mmu.write(self.addresses, start, words)
+		for code in range(max(start, 0), min(start + len(words), self.program_size)):
+			self.__forget(code)
+
+	def __set_disk(self, address: int, words: array, journal: list|None = None):
+		if journal is not None:
+			old = read_words(self.disk, address, len(words))
+			journal.extend((WRITE_DISK, address + i, old[i], word) for i, word in enumerate(words))
+		write_words(self.disk, address, words)
+
+	def __fill(self, value: int, address: int, count: int, size: int) -> array:
+		# count copies of value, checked against the size of the storage
+		# first so a huge count fails instead of allocating
+		if address + count > size:
+			raise IndexError(f"address {address + count - 1} out of range")
+		return array(DISK_WORD.typecode, [value]) * count
+
+	def block(self, opcode: Opcode, a: int, b: int, count: int, journal: list|None = None) -> int|None:
+		# Runs a block instruction with a and b the values of its registers:
+		#   MCOPY  M[a..] = M[b..]     DCOPY  D[a..] = D[b..]
+		#   MFILL  M[a..] = b          DFILL  D[a..] = b
+		#   MSUM   sum of M[b..]       DSUM   sum of D[b..]
+		#   MCMP   M[a..] vs M[b..]    DCMP   D[a..] vs D[b..]
+		#   BREAD  M[a..] = D[b..]     BWRITE D[b..] = M[a..]
+		# each over count words. Copies are whole before they are written,
+		# so ranges may overlap. Sums and comparisons are returned for ri,
+		# comparisons as -1, 0 or 1 like memcmp.
+		if count < 0:
+			raise ValueError(f"Negative count {count}")
+		disk = self.disk
+		match opcode:
+			case Opcode.MCOPY:
+				self.set_vals(a, self.get_vals(b, count), journal)
+			case Opcode.MFILL:
+				size = 1 << PagedMMU.ADDRESS_BITS if isinstance(self.addresses, PagedMMU) else len(self.addresses)
+				self.set_vals(a, self.__fill(b, self.__mmu(a), count, size), journal)
+			case Opcode.MSUM:
+				return sum(self.get_vals(b, count))
+			case Opcode.MCMP:
+				x, y = self.get_vals(a, count), self.get_vals(b, count)
+				return (x > y) - (x < y)
+			case Opcode.DCOPY:
+				self.__set_disk(a, read_words(disk, b, count), journal)
+			case Opcode.DFILL:
+				self.__set_disk(a, self.__fill(b, a, count, len(disk)), journal)
+			case Opcode.DSUM:
+				return sum(read_words(disk, b, count))
+			case Opcode.DCMP:
+				x, y = read_words(disk, a, count), read_words(disk, b, count)
+				return (x > y) - (x < y)
+			case Opcode.BREAD:
+				self.set_vals(a, read_words(disk, b, count), journal)
+			case Opcode.BWRITE:
+				self.__set_disk(b, self.get_vals(a, count), journal)
+
+@dataclass(slots = True)
 class Token:
 	tokentype: TokenType
 	lexeme: str
@@ -183,95 +995,58 @@ class Token:
 			return f"{self.tokentype.name}: {self.literal}"
 		return f"{self.tokentype.name}"
 
+
+# One alternative per kind of lexeme, tried in order at each position
+TOKEN_PATTERN = re.compile(
+	r"(?P<space>[ \t\n]+)"
+	r"|(?P<number>\d+)"
+	r"|(?P<label>[^\W\d_][^\W_]*):"
+	r"|(?P<word>[^\W\d_][^\W_]*)"
+	r"|(?P<punctuation>[,=\[\]@$])"
+	r"|(?P<comment>#)"
+	r"|(?P<error>.)"
+)
+PUNCTUATION = {
+	",": TokenType.COMMA,
+	"=": TokenType.EQUALS,
+	"[": TokenType.LBRACKET,
+	"]": TokenType.RBRACKET,
+	"@": TokenType.AT,
+	"$": TokenType.DOLLAR,
+}
+WORDS = {**KEYWORDS, **{register: TokenType.REGISTER for register in REGISTERS}}
+
+
 class Scanner:
 	def __init__(self, memory: Memory, lines: list[str]):
 		self.memory = memory
 
-	
-	def scan_line(self, instruction) -> list[Token]|None:
-		# Actual Line Number no MMU
-		self.start = 0
-		self.curr = 0
-		self.line = instruction
-		self.tokens = []
-
-		while not self.__is_at_end():
-			self.start = self.curr
-			c = self.__advance()
-			match c:
-				case ",":
-					self.__add_token(TokenType.COMMA)
-				case "=":
-					self.__add_token(TokenType.EQUALS)
-				case "[":
-					self.__add_token(TokenType.LBRACKET)
-				case "]":
-					self.__add_token(TokenType.RBRACKET)
-				case "@":
-					self.__add_token(TokenType.AT)
-				case "$":
-					self.__add_token(TokenType.DOLLAR)
-				case " "|"\n"|"\t":
-					...
-				case "#":
-					break
-				case _:
-					if c.isnumeric():
-						self.__number()
-					elif c.isalpha():
-						self.__identifier(memory)
-					else: 
-						self.memory.error("Lexeme not found")
-		return self.tokens
-
-	def __is_at_end(self):
-			if type(self.line) is int:
-				self.memory.error("HALT instruction not found")
-			return self.curr >= len(self.line)
-
-	def __advance(self):
-		c = self.line[self.curr]
-		self.curr += 1
-		return c
-	
-	def __add_token(self, token: TokenType, literal: str|None = None):
-		lex = Token(token, self.line[self.start: self.curr], literal)
-		self.tokens.append(lex)
-
-	def __number(self):
-		while not self.__is_at_end() and self.__peek().isnumeric():
-			self.__advance()
-		number = int(self.line[self.start: self.curr])
-		self.__add_token(TokenType.NUMBER, number)
-		...
-
-	def __identifier(self, memory: Memory):
-		while not self.__is_at_end() and self.__peek().isalnum():
-			self.__advance()
-		val = self.line[self.start: self.curr]
-		if self.__peek() == ":":
-			self.__advance()
-			self.__add_token(TokenType.LABEL, val)
-		else:
-			token_type = None
-			if val in KEYWORDS:
-				token_type = KEYWORDS[val]
-			elif val in memory.registers:
-				token_type = TokenType.REGISTER
-			else:
-				token_type = TokenType.LITERAL
-			self.__add_token(token_type, val)
-
-	def __peek(self) -> str:
-		if self.__is_at_end():
-			return Token(TokenType.EOF, "", "")	
-		return self.line[self.curr]
+	def scan_line(self, instruction: str) -> list[Token]:
+		# One regular expression match per token rather than a method call
+		# per character
+		tokens = []
+		for match in TOKEN_PATTERN.finditer(instruction):
+			kind = match.lastgroup
+			lexeme = match.group()
+			if kind == "word":
+				tokens.append(Token(WORDS.get(lexeme, TokenType.LITERAL), lexeme, lexeme))
+			elif kind == "punctuation":
+				tokens.append(Token(PUNCTUATION[lexeme], lexeme, None))
+			elif kind == "number":
+				tokens.append(Token(TokenType.NUMBER, lexeme, int(lexeme)))
+			elif kind == "label":
+				tokens.append(Token(TokenType.LABEL, lexeme, lexeme[:-1]))
+			elif kind == "comment":
+				break
+			elif kind == "error":
+				self.memory.error(f"Lexeme not found at column {match.start()}")
+		return tokens
 
 class Parser:
 	def __init__(self, memory: Memory):
 		self.memory = memory
 	
-	def parse(self, tokens) -> Callable|None:
+	def parse(self, tokens) -> Instruction:
 		if DEBUG:
 			print(tokens)
 		self.tokens = tokens
@@ -283,381 +1058,2500 @@ class Parser:
 				statement = self.__parse_load_statement()
 			case TokenType.STORE:
 				statement = self.__parse_store_statement()
-			case TokenType.READ:
-				statement = self.__parse_read_statement()
-			case TokenType.WRITE:
-				statement = self.__parse_write_statement()
-			case TokenType.ADD:
-				statement = self.__parse_add_statement()
-			case TokenType.SUB:
-				statement = self.__parse_sub_statement()
-			case TokenType.MUL:
-				statement = self.__parse_mul_statement()
-			case TokenType.DIV:
-				statement = self.__parse_div_statement()
-			case TokenType.INC:
+			case TokenType.READ | TokenType.WRITE:
+				statement = self.__parse_disk_statement()
+			case TokenType.ADD | TokenType.SUB | TokenType.MUL | TokenType.DIV:
+				statement = self.__parse_arithmetic_statement()
+			case TokenType.INC | TokenType.CPUID:
 				statement = self.__parse_inc_statement()
-			case TokenType.HALT:
-				statement = self.__parse_halt_statement()
+			case TokenType.CAS:
+				statement = self.__parse_cas_statement()
+			case TokenType.FAA:
+				statement = self.__parse_faa_statement()
+			case TokenType.MCOPY | TokenType.MFILL | TokenType.MSUM | TokenType.MCMP | TokenType.DCOPY | TokenType.DFILL | TokenType.DSUM | TokenType.DCMP | TokenType.BREAD | TokenType.BWRITE:
+				statement = self.__parse_block_statement()
 			case TokenType.LABEL:
 				statement = self.__parse_label_statement()
 			case TokenType.BR:
 				statement = self.__parse_br_statement()
-			case TokenType.BLT:
-				statement = self.__parse_blt_statement()
-			case TokenType.BGT:
-				statement = self.__parse_bgt_statement()
-			case TokenType.BLEQ:
-				statement = self.__parse_bleq_statement()
-			case TokenType.BGEQ:
-				statement = self.__parse_bgeq_statement()
-			case TokenType.BEQ:
-				statement = self.__parse_beq_statement()
+			case TokenType.BLT | TokenType.BGT | TokenType.BLEQ | TokenType.BGEQ | TokenType.BEQ | TokenType.BNEQ:
+				statement = self.__parse_binary_br_statement()
 			case TokenType.PRINT:
 				statement = self.__parse_print_statement()
-			case TokenType.DUMP:
-				statement = self.__parse_dump_statement()
-			case TokenType.SKIP:
-				statement = self.__parse_skip_statement()
-			case TokenType.NUMBER|TokenType.EOL: # Do nothing in these cases
-				statement = lambda: 0
+			case TokenType.HALT | TokenType.SKIP | TokenType.DUMP:
+				statement = Instruction(OPCODES[self.__advance().tokentype])
+			case TokenType.NUMBER: # Data, does nothing when executed
+				statement = Instruction(Opcode.NOP, operand=self.__advance().literal)
+			case TokenType.EOL:
+				statement = Instruction(Opcode.NOP)
 			case _:
 				self.memory.error(f"Parse Error: Unexpected token {curr}")
 		return statement
 
 	def __parse_load_statement(self):
 		self.__consume(TokenType.LOAD)
-		register = self.__consume(TokenType.REGISTER)
+		register = self.__register()
 		self.__consume(TokenType.COMMA)
-		value_at = self.__parse_load_addr_types()
-		def lambda_():
-			self.memory.registers[register.lexeme] = value_at()
-		return lambda_
-	
-	def __parse_load_addr_types(self):
-		curr = self.__peek()
-		match curr.tokentype:
-			case TokenType.NUMBER:
-				func = self.__parse_direct_addr()
-			case TokenType.EQUALS:
-				func = self.__parse_immediate_addr()
-			case TokenType.LBRACKET:
-				func = self.__parse_index_addr()
-			case TokenType.AT:
-				func = self.__parse_indirect_addr()
-			case TokenType.DOLLAR:
-				func = self.__parse_relative_addr()
-			case _:
-				raise Exception("Error parsing load addr")
-		return func
-		...
+		mode, operand, rj = self.__parse_addr_types(LOAD_MODES)
+		return Instruction(Opcode.LOAD, register, rj, mode, operand)
 
 	def __parse_store_statement(self):
 		self.__consume(TokenType.STORE)
-		register = self.__consume(TokenType.REGISTER)
+		register = self.__register()
 		self.__consume(TokenType.COMMA)
-		value_to = self.__parse_store_addr_types()
-		def lambda_():
-			self.memory.addresses[value_to] = str(self.memory.registers[register.literal])
-		return lambda_
+		mode, operand, rj = self.__parse_addr_types(STORE_MODES)
+		return Instruction(Opcode.STORE, register, rj, mode, operand)
 
-	def __parse_store_addr_types(self) -> int:
+	def __parse_disk_statement(self):
+		# READ and WRITE: direct addressing and index addressing
+		opcode = OPCODES[self.__advance().tokentype]
+		ri = self.__register()
+		self.__consume(TokenType.COMMA)
+		mode, operand, rj = self.__parse_addr_types(DISK_MODES)
+		return Instruction(opcode, ri, rj, mode, operand)
+
+	def __parse_addr_types(self, modes: tuple['Mode', ...]) -> tuple['Mode', int, str|None]:
 		curr = self.__advance()
+		rj = None
 		match curr.tokentype:
 			case TokenType.NUMBER:
-				return curr.literal
+				mode = Mode.DIRECT
+				operand = curr.literal
+			case TokenType.EQUALS:
+				mode = Mode.IMMEDIATE
+				operand = self.__consume(TokenType.NUMBER).literal
 			case TokenType.LBRACKET:
-				num = self.__consume(TokenType.NUMBER).literal
+				mode = Mode.INDEX
+				operand = self.__consume(TokenType.NUMBER).literal
 				self.__consume(TokenType.COMMA)
-				reg = self.__consume(TokenType.REGISTER)
+				rj = self.__register()
 				self.__consume(TokenType.RBRACKET)
-				return self.memory.registers[reg] + num
+			case TokenType.AT:
+				mode = Mode.INDIRECT
+				operand = self.__consume(TokenType.NUMBER).literal
 			case TokenType.DOLLAR:
-				offset = self.__consume(TokenType.NUMBER).literal
-				return self.memory.status_registers["ip"] + offset
+				mode = Mode.RELATIVE
+				operand = self.__consume(TokenType.NUMBER).literal
 			case t:
-				self.memory.error(f"Parse Error: Expected NUMBER or RBRACKET but found {t}")
-
-	def __parse_read_statement(self):
-		# direct addressing and index addressing
-		self.__consume(TokenType.READ)
-		ri = self.__consume(TokenType.REGISTER)
+				self.memory.error(f"Parse Error: Expected an address but found {t}")
+		if mode not in modes:
+			self.memory.error(f"Parse Error: {mode.name} addressing not allowed here")
+		return mode, operand, rj
+
+	def __parse_arithmetic_statement(self):
+		opcode = OPCODES[self.__advance().tokentype]
+		r1 = self.__register()
 		self.__consume(TokenType.COMMA)
-		nxt = self.__advance()
-		match nxt.tokentype:
-			case TokenType.NUMBER: # direct addressing
-				disk_index = nxt.literal
-			case TokenType.LBRACKET: # index addressing
-				disk_addr = self.__consume(TokenType.NUMBER).literal
-				self.__consume(TokenType.COMMA)
-				rj = self.__consume(TokenType.REGISTER).literal
-				disk_index = disk_addr + self.memory.registers[rj]
-			case t:
-				self.memory.error(f"Parse Error: Expected NUMBER or LBRACKET but found {t}")
-		def lambda_():
-			self.memory.registers[ri.literal] = self.memory.disk[disk_index]
-		return lambda_
+		r2 = self.__register()
+		return Instruction(opcode, r1, r2)
 
-	def __parse_write_statement(self):
-		self.__consume(TokenType.WRITE)
-		ri = self.__consume(TokenType.REGISTER)
-		self.__consume(TokenType.COMMA)
-		nxt = self.__advance()
-		match nxt.tokentype:
-			case TokenType.NUMBER: # direct addressing
-				disk_index = nxt.literal
-			case TokenType.LBRACKET:
-				disk_addr = self.__consume(TokenType.NUMBER).literal
-				self.__consume(TokenType.COMMA)
-				rj = self.__consume(TokenType.REGISTER).literal
-				disk_index = disk_addr + self.memory.registers[rj]
-			case t:
-				self.memory.error(f"Parse Error: Expected NUMBER or LBRACKET but found {t}")
-		def lambda_():
-			self.memory.disk[disk_index] = self.memory.registers[ri.literal]
-		return lambda_
-
-	def __parse_add_statement(self):
-		self.__consume(TokenType.ADD)
-		r1 = self.__consume(TokenType.REGISTER).literal
+	def __parse_inc_statement(self):
+		# INC and CPUID: one register
+		opcode = OPCODES[self.__advance().tokentype]
+		r = self.__register()
+		return Instruction(opcode, r)
+
+	def __parse_cas_statement(self):
+		self.__consume(TokenType.CAS)
+		ri = self.__register()
 		self.__consume(TokenType.COMMA)
-		r2 = self.__consume(TokenType.REGISTER).literal
-		def lambda_():
-			self.memory.registers[r1] = self.memory.registers[r1] + self.memory.registers[r2]
-		return lambda_
-	
-	def __parse_sub_statement(self):
-		r1 = self.__consume(TokenType.REGISTER).literal
+		rj = self.__register()
 		self.__consume(TokenType.COMMA)
-		r2 = self.__consume(TokenType.REGISTER).literal
-		def lambda_():
-			self.memory.registers[r1] = self.memory.registers[r1] - self.memory.registers[r2]
+		mode, operand, _ = self.__parse_addr_types(CAS_MODES)
+		return Instruction(Opcode.CAS, ri, rj, mode, operand)
 
-		return lambda_
-	def __parse_mul_statement(self):
-		r1 = self.__consume(TokenType.REGISTER).literal
+	def __parse_faa_statement(self):
+		self.__consume(TokenType.FAA)
+		register = self.__register()
 		self.__consume(TokenType.COMMA)
-		r2 = self.__consume(TokenType.REGISTER).literal
-		def lambda_():
-			self.memory.registers[r1] = self.memory.registers[r1] * self.memory.registers[r2]
-		return lambda_
+		mode, operand, rj = self.__parse_addr_types(STORE_MODES)
+		return Instruction(Opcode.FAA, register, rj, mode, operand)
 
-	def __parse_div_statement(self):
-		r1 = self.__consume(TokenType.REGISTER).literal
+	def __parse_block_statement(self):
+		# Two registers, then the count as =Num or a register
+		opcode = OPCODES[self.__advance().tokentype]
+		ri = self.__register()
 		self.__consume(TokenType.COMMA)
-		r2 = self.__consume(TokenType.REGISTER).literal
-		def lambda_():
-			self.memory.registers[r1] = self.memory.registers[r1] / self.memory.registers[r2]
-			self.memory.registers[r2] = self.memory.registers[r1] % self.memory.registers[r2]
-		return lambda_
-
-	def __parse_inc_statement(self):
-		self.__consume(TokenType.INC)
-		r = self.__consume(TokenType.REGISTER).literal
-		def lambda_():
-			self.memory.registers[r] = int(self.memory.registers[r]) + 1
-		return lambda_
+		rj = self.__register()
+		self.__consume(TokenType.COMMA)
+		if self.__match(TokenType.EQUALS):
+			return Instruction(opcode, ri, rj, Mode.IMMEDIATE, self.__consume(TokenType.NUMBER).literal)
+		return Instruction(opcode, ri, rj, Mode.REGISTER, self.__register())
 
 	def __parse_label_statement(self):
+		# Labels are collected by the Assembler before execution
 		label = self.__consume(TokenType.LABEL).literal
-		def lambda_():
-			self.memory.label_table[label] = self.memory.status_registers["ip"]
-		return lambda_
-
-	def __goto_label(self, label):
-		addr = self.memory.label_table.get(label)
-		if addr is None:
-			self.memory.error(f"Parse Error: Label {label} does not exist")
-		self.memory.status_registers["ip"] = addr
+		return Instruction(Opcode.LABEL, label=label)
 
 	def __parse_br_statement(self):
 		self.__consume(TokenType.BR)
 		label = self.__consume(TokenType.LITERAL).literal
-		def lambda_():
-			self.__goto_label(label)
-		return lambda_
+		return Instruction(Opcode.BR, label=label)
 
-	def __binary_br_helper(self) -> tuple[str, str, str]: # ri, rj, label
-		self.__consume(TokenType.BLT)
-		ri = self.__consume(TokenType.REGISTER).literal
+	def __parse_binary_br_statement(self):
+		opcode = OPCODES[self.__advance().tokentype]
+		ri = self.__register()
 		self.__consume(TokenType.COMMA)
-		rj = self.__consume(TokenType.REGISTER).literal
+		rj = self.__register()
 		self.__consume(TokenType.COMMA)
 		label = self.__consume(TokenType.LITERAL).literal
-		return ri, rj, label
+		return Instruction(opcode, ri, rj, label=label)
+
+	def __parse_print_statement(self):
+		self.__consume(TokenType.PRINT)
+		nxt = self.__peek()
+		match nxt.tokentype:
+			case TokenType.REGISTER:
+				r = self.__register()
+				return Instruction(Opcode.PRINT, r)
+			case TokenType.NUMBER:
+				n = self.__consume(TokenType.NUMBER).literal
+				return Instruction(Opcode.PRINT, mode=Mode.DIRECT, operand=n)
+			case t:
+				self.memory.error(f"Parse Error: Expected REGISTER or NUMBER but found {t}")
+
+	
+	def __register(self) -> int:
+		return REGISTER_NUMBERS[self.__consume(TokenType.REGISTER).literal]
+
+	def __previous(self) -> Token:
+		return self.tokens[self.current - 1]
+
+	def __advance(self) -> Token:
+		self.current += 1
+		return self.__previous()		
+
+	def __peek(self) -> TokenType:
+		if self.__is_at_end():
+			return Token(TokenType.EOL, "", "")
+		return self.tokens[self.current]
+	
+	def __check(self, token: TokenType) -> bool:
+		return self.__peek().tokentype == token
+	
+	def __match(self, token: TokenType) -> Token|None:
+		if self.__check(token):
+			return self.__advance()
+		return None
+
+	def __consume(self, token: TokenType) -> Token:
+		v = self.__match(token)
+		if v is None:
+			self.memory.error(f"Parse Error: Token {token} expected but not found")
+		return v
 		
-	def __parse_blt_statement(self):
-		ri, rj, label = self.__binary_br_helper()
+	def __is_at_end(self):
+		return self.current >= len(self.tokens)
+
+
+class Assembler:
+	# Turns source lines into encoded words in one pass over the lines, so
+	# they can be read lazily and only the words are kept. Branches to a
+	# label are encoded without their target and patched once every label
+	# is known.
+	def __init__(self, memory: Memory):
+		self.memory = memory
+		self.scanner = Scanner(memory, [])
+		self.parser = Parser(memory)
+
+	def assemble(self, lines: Iterable[str]) -> tuple[array, dict[str, int]]:
+		memory = self.memory
+		memory.label_table = {}
+		memory.source = None
+		status_registers = memory.status_registers
+		words = array("q")
+		fixups = [] # (address, label) of instructions that refer to a label
+		for address, line in enumerate(lines):
+			status_registers["ip"] = address # For error messages
+			line = line.strip()
+			try:
+				instruction = self.parser.parse(self.scanner.scan_line(line))
+				if instruction.opcode == Opcode.LABEL:
+					if instruction.label in memory.label_table:
+						memory.error(f"Label {instruction.label} defined more than once")
+					memory.label_table[instruction.label] = address
+				elif instruction.label is not None:
+					fixups.append((address, instruction.label))
+				words.append(encode_instruction(instruction))
+			except ValueError as e:
+				status_registers["error"] = 1
+				raise AsmError(str(e), address, line)
+			except AsmError as e:
+				e.source = line
+				raise
+
+		for address, label in fixups:
+			status_registers["ip"] = address
+			words[address] |= memory.resolve_label(label)
+		status_registers["ip"] = 0
+		return words, dict(memory.label_table)
+
+
+class Executor:
+	# Builds the closure that Memory.fde_cycle runs for a decoded instruction.
+	# With a journal, instructions that write memory or disk also append
+	# (kind, address, old value, new value) to it.
+	def __init__(self, memory: Memory, journal: list|None = None):
+		self.memory = memory
+		self.journal = journal
+
+	def build(self, instruction: Instruction, address: int) -> Callable:
+		match instruction.opcode:
+			case Opcode.NOP | Opcode.LABEL:
+				return lambda: 0
+			case Opcode.LOAD:
+				return self.__build_load(instruction, address)
+			case Opcode.STORE:
+				return self.__build_store(instruction, address)
+			case Opcode.READ:
+				return self.__awaiting(self.__build_read(instruction, address), self.memory.disk_file is not None)
+			case Opcode.WRITE:
+				return self.__awaiting(self.__build_write(instruction, address), self.memory.disk_file is not None)
+			case Opcode.ADD | Opcode.SUB | Opcode.MUL | Opcode.DIV:
+				return self.__build_arithmetic(instruction)
+			case Opcode.INC:
+				return self.__build_inc(instruction)
+			case Opcode.BR:
+				return self.__build_br(instruction)
+			case Opcode.HALT:
+				return self.__build_halt()
+			case Opcode.SKIP:
+				return self.__build_skip()
+			case Opcode.PRINT:
+				return self.__awaiting(self.__build_print(instruction))
+			case Opcode.DUMP:
+				return self.__awaiting(self.__build_dump())
+			case Opcode.CAS:
+				return self.__build_cas(instruction, address)
+			case Opcode.FAA:
+				return self.__build_faa(instruction, address)
+			case Opcode.CPUID:
+				return self.__build_cpuid(instruction)
+			case _ if instruction.opcode in BLOCK_OPCODES:
+				disk = instruction.opcode not in (Opcode.MCOPY, Opcode.MFILL, Opcode.MSUM, Opcode.MCMP)
+				return self.__awaiting(self.__build_block(instruction), disk and self.memory.disk_file is not None)
+			case _:
+				return self.__build_binary_br(instruction)
+
+	def __awaiting(self, ast: Callable, io: bool = True) -> Callable:
+		# With the async clock I/O suspends the machine afterwards, so
+		# VM.run_async lets other machines run
+		if self.memory.clock != "async" or not io:
+			return ast
+		status_registers = self.memory.status_registers
 		def lambda_():
-			registers = self.memory.registers
-			if registers[ri] < registers[rj]:
-				self.__goto_label(label)
+			ast()
+			status_registers["halt"] = SUSPENDED
 		return lambda_
 
-	def __parse_bgt_statement(self):
-		ri, rj, label = self.__binary_br_helper()
+	def __build_operand(self, instruction: Instruction, address: int) -> Callable:
+		# Value read by LOAD
+		memory = self.memory
+		registers = memory.registers
+		n = instruction.operand
+		rj = instruction.rj
+		match instruction.mode:
+			case Mode.DIRECT:
+				return lambda: memory.get_val(n)
+			case Mode.IMMEDIATE:
+				return lambda: n
+			case Mode.INDEX:
+				return lambda: memory.get_val(n + registers[rj])
+			case Mode.INDIRECT:
+				return lambda: memory.get_val(memory.get_val(n))
+			case Mode.RELATIVE:
+				return lambda: memory.addresses[address + n]
+
+	def __build_target(self, instruction: Instruction, address: int) -> Callable:
+		# Address written by STORE, or disk index used by READ and WRITE
+		registers = self.memory.registers
+		n = instruction.operand
+		rj = instruction.rj
+		match instruction.mode:
+			case Mode.DIRECT:
+				return lambda: n
+			case Mode.INDEX:
+				def lambda_():
+					target = n + registers[rj]
+					if target < 0:
+						out_of_range(target)
+					return target
+				return lambda_
+			case Mode.RELATIVE:
+				target = address + n
+				return lambda: target
+
+	def __build_load(self, instruction: Instruction, address: int):
+		registers = self.memory.registers
+		ri = instruction.ri
+		value_at = self.__build_operand(instruction, address)
 		def lambda_():
-			registers = self.memory.registers
-			if registers[ri] > registers[rj]:
-				self.__goto_label(label)
+			registers[ri] = value_at()
 		return lambda_
-		...
 
-	def __parse_bleq_statement(self):
-		ri, rj, label = self.__binary_br_helper()
+	def __build_store(self, instruction: Instruction, address: int):
+		memory = self.memory
+		registers = memory.registers
+		ri = instruction.ri
+		value_to = self.__build_target(instruction, address)
+		journal = self.journal
+		if journal is not None:
+			def lambda_():
+				target = value_to()
+				journal.append((WRITE_MEMORY, target, memory.get_val(target), registers[ri]))
+				memory.set_val(target, registers[ri])
+			return lambda_
 		def lambda_():
-			registers = self.memory.registers
-			if registers[ri] <= registers[rj]:
-				self.__goto_label(label)
+			memory.set_val(value_to(), registers[ri])
 		return lambda_
-		...
 
-	def __parse_bgeq_statement(self):
-		ri, rj, label = self.__binary_br_helper()
+	def __build_read(self, instruction: Instruction, address: int):
+		memory = self.memory
+		registers = memory.registers
+		ri = instruction.ri
+		disk_index = self.__build_target(instruction, address)
 		def lambda_():
-			registers = self.memory.registers
-			if registers[ri] >= registers[rj]:
-				self.__goto_label(label)
+			registers[ri] = memory.disk[disk_index()]
 		return lambda_
-		...
 
-	def __parse_beq_statement(self):
-		ri, rj, label = self.__binary_br_helper()
+	def __build_write(self, instruction: Instruction, address: int):
+		memory = self.memory
+		registers = memory.registers
+		ri = instruction.ri
+		disk_index = self.__build_target(instruction, address)
+		journal = self.journal
+		if journal is not None:
+			def lambda_():
+				index = disk_index()
+				journal.append((WRITE_DISK, index, memory.disk[index], registers[ri]))
+				memory.disk[index] = registers[ri]
+			return lambda_
 		def lambda_():
-			registers = self.memory.registers
-			if registers[ri] == registers[rj]:
-				self.__goto_label(label)
+			memory.disk[disk_index()] = registers[ri]
 		return lambda_
-		...
 
-	def __parse_bneq_statement(self):
-		ri, rj, label = self.__binary_br_helper()
-		def lambda_():
-			registers = self.memory.registers
-			if registers[ri] != registers[rj]:
-				self.__goto_label(label)
+	def __build_arithmetic(self, instruction: Instruction):
+		registers = self.memory.registers
+		r1 = instruction.ri
+		r2 = instruction.rj
+		match instruction.opcode:
+			case Opcode.ADD:
+				def lambda_():
+					registers[r1] = registers[r1] + registers[r2]
+			case Opcode.SUB:
+				def lambda_():
+					registers[r1] = registers[r1] - registers[r2]
+			case Opcode.MUL:
+				def lambda_():
+					registers[r1] = registers[r1] * registers[r2]
+			case Opcode.DIV: # Quotient in r1, remainder in r2
+				def lambda_():
+					registers[r1], registers[r2] = divmod(registers[r1], registers[r2])
 		return lambda_
 
-	def __parse_halt_statement(self):
-		self.__consume(TokenType.HALT)
+	def __build_inc(self, instruction: Instruction):
+		registers = self.memory.registers
+		r = instruction.ri
 		def lambda_():
-			self.memory.status_registers["halt"] = 1
+			registers[r] = registers[r] + 1
 		return lambda_
 
-	def __parse_skip_statement(self):
+	def __build_br(self, instruction: Instruction):
+		target = instruction.operand
+		status_registers = self.memory.status_registers
 		def lambda_():
-			sleep(SKIP_TIME)
+			status_registers["ip"] = target
 		return lambda_
 
-	def __parse_print_statement(self):
-		self.__consume(TokenType.PRINT)
-		nxt = self.__peek()
-		match nxt.tokentype:
-			case TokenType.REGISTER:
-				r = self.__consume(TokenType.REGISTER).literal
-				return lambda: print(f"{r}: {self.memory.registers[r]}")
-			case TokenType.NUMBER:
-				n = self.__consume(TokenType.NUMBER).literal
-				return lambda: print(f"M[{n}]: {self.memory.addresses[n]}")
-			case t:
-				self.memory.error(f"Parse Error: Expected REGISTER or NUMBER but found {t}")
-				
+	def __build_binary_br(self, instruction: Instruction):
+		target = instruction.operand
+		registers = self.memory.registers
+		status_registers = self.memory.status_registers
+		ri = instruction.ri
+		rj = instruction.rj
+		match instruction.opcode:
+			case Opcode.BLT:
+				def lambda_():
+					if registers[ri] < registers[rj]:
+						status_registers["ip"] = target
+			case Opcode.BGT:
+				def lambda_():
+					if registers[ri] > registers[rj]:
+						status_registers["ip"] = target
+			case Opcode.BLEQ:
+				def lambda_():
+					if registers[ri] <= registers[rj]:
+						status_registers["ip"] = target
+			case Opcode.BGEQ:
+				def lambda_():
+					if registers[ri] >= registers[rj]:
+						status_registers["ip"] = target
+			case Opcode.BEQ:
+				def lambda_():
+					if registers[ri] == registers[rj]:
+						status_registers["ip"] = target
+			case Opcode.BNEQ:
+				def lambda_():
+					if registers[ri] != registers[rj]:
+						status_registers["ip"] = target
+		return lambda_
 
-	def __parse_dump_statement(self):
-		self.__consume(TokenType.DUMP)
+	def __build_halt(self):
+		status_registers = self.memory.status_registers
 		def lambda_():
-			print(f"Registers: {self.memory.registers}")
-			print(f"Label Table: {self.memory.label_table}")
-			print(f"Main Memory: {self.memory.addresses}")
+			status_registers["halt"] = 1
 		return lambda_
 
-
-	def __parse_direct_addr(self):
-		number = self.__match(TokenType.NUMBER).literal
+	def __build_cas(self, instruction: Instruction, address: int):
+		# If the word equals ri it is replaced by rj. Either way rj receives
+		# the word's old value, so ri == rj afterwards means it succeeded.
+		memory = self.memory
+		registers = memory.registers
+		ri = instruction.ri
+		rj = instruction.rj
+		target = self.__build_target(instruction, address)()
+		journal = self.journal
 		def lambda_():
-			return self.memory.get_val(number)
+			with memory.atomic:
+				old = memory.get_val(target)
+				if old == registers[ri]:
+					if journal is not None:
+						journal.append((WRITE_MEMORY, target, old, registers[rj]))
+					memory.set_val(target, registers[rj])
+			registers[rj] = old
 		return lambda_
-	
-	def __parse_immediate_addr(self):
-		self.__match(TokenType.EQUALS)
-		number = self.__match(TokenType.NUMBER).literal
+
+	def __build_faa(self, instruction: Instruction, address: int):
+		# Adds ri to the word, ri receives the word's old value
+		memory = self.memory
+		registers = memory.registers
+		ri = instruction.ri
+		value_to = self.__build_target(instruction, address)
+		journal = self.journal
 		def lambda_():
-			return number
+			target = value_to()
+			with memory.atomic:
+				old = memory.get_val(target)
+				if journal is not None:
+					journal.append((WRITE_MEMORY, target, old, old + registers[ri]))
+				memory.set_val(target, old + registers[ri])
+			registers[ri] = old
 		return lambda_
 
-	def __parse_index_addr(self):
-		self.__match(TokenType.LBRACKET)
-		num = self.__consume(TokenType.NUMBER).literal
-		self.__consume(TokenType.COMMA)
-		register = self.__consume(TokenType.REGISTER).literal
+	def __build_cpuid(self, instruction: Instruction):
+		registers = self.memory.registers
+		r = instruction.ri
+		cpu = self.memory.cpu
 		def lambda_():
-			return self.memory.addresses[num + self.memory.registers[register]]
+			registers[r] = cpu
 		return lambda_
 
-	def __parse_indirect_addr(self):
-		self.__consume(TokenType.AT)
-		num = self.__consume(TokenType.NUMBER).literal
-		def lambda_():
-			first = self.memory.addresses[num]
-			second = self.memory.addresses[first]
-			return second
+	def __build_block(self, instruction: Instruction):
+		memory = self.memory
+		registers = memory.registers
+		opcode = instruction.opcode
+		ri = instruction.ri
+		rj = instruction.rj
+		n = instruction.operand
+		count = (lambda: registers[n]) if instruction.mode == Mode.REGISTER else (lambda: n)
+		journal = self.journal
+		if opcode in BLOCK_RESULTS:
+			def lambda_():
+				registers[ri] = memory.block(opcode, registers[ri], registers[rj], count())
+		else:
+			def lambda_():
+				memory.block(opcode, registers[ri], registers[rj], count(), journal)
 		return lambda_
 
-	def __parse_relative_addr(self):
-		self.__consume(TokenType.DOLLAR)
-		num = self.__consume(TokenType.NUMBER).literal
-		def lambda_():
-			current_location = self.memory.status_registers["ip"]
-			return self.memory.addresses[current_location + num]
+	def __build_skip(self):
+		status_registers = self.memory.status_registers
+		match self.memory.clock:
+			case "real":
+				flush = self.memory.output.flush
+				def lambda_():
+					status_registers["ticks"] += SKIP_TICKS
+					flush()
+					sleep(SKIP_TIME)
+			case "simulated":
+				def lambda_():
+					status_registers["ticks"] += SKIP_TICKS
+			case "async":
+				def lambda_():
+					status_registers["ticks"] += SKIP_TICKS
+					status_registers["halt"] = SUSPENDED
 		return lambda_
 
-	
-	def __previous(self) -> Token:
-		return self.tokens[self.current - 1]
+	def __build_print(self, instruction: Instruction):
+		memory = self.memory
+		registers = memory.registers
+		write = memory.output.write
+		if instruction.mode == Mode.DIRECT:
+			n = instruction.operand
+			return lambda: write(f"M[{n}]: {memory.addresses[n]}\n")
+		r = instruction.ri
+		name = REGISTERS[r]
+		return lambda: write(f"{name}: {registers[r]}\n")
 
-	def __advance(self) -> Token:
-		self.current += 1
-		return self.__previous()		
+	def __build_dump(self):
+		return self.memory.dump
 
-	def __peek(self) -> TokenType:
-		if self.__is_at_end():
-			return Token(TokenType.EOL, "", "")
-		return self.tokens[self.current]
-	
-	def __check(self, token: TokenType) -> bool:
-		return self.__peek().tokentype == token
-	
-	def __match(self, token: TokenType) -> Token|None:
-		if self.__check(token):
-			return self.__advance()
-		return None
 
-	def __consume(self, token: TokenType) -> Token:
-		v = self.__match(token)
-		if v is None:
-			raise Exception(f"Token {token} expected but not found")
-		return v
-		
-	def __is_at_end(self):
-		return self.current >= len(self.tokens)
+@dataclass
+class Block:
+	start: int
+	end: int # one past its last address
+	successors: list[int] = field(default_factory = list) # starts of the blocks it can go to, or END
+	predecessors: list[int] = field(default_factory = list)
+
+
+@dataclass
+class Loop:
+	header: int # the block every iteration starts with
+	blocks: set[int]
+
+
+class ControlFlowGraph:
+	# Basic blocks of a program and the edges between them, found without
+	# running it. A block ends at a branch, HALT or a word that isn't an
+	# instruction, or before an address a taken branch continues at (its
+	# label's address plus one). From the blocks reachable from address 0
+	# come their dominators and natural loops, and the problems that can be
+	# reported before the program runs: no reachable HALT, branches outside
+	# the program, and as warnings code that may run off the end of the
+	# program and unreachable code. Problems are (address, message) pairs.
+	END = -1 # successor of a block that runs off the end of the program
+
+	def __init__(self, words: Iterable[int]):
+		program = []
+		for word in words:
+			try:
+				program.append(decode_instruction(word))
+			except ValueError:
+				program.append(None)
+		self.program = program
+		self.targets = {} # address of a branch: address it continues at when taken
+		self.errors = []
+		self.warnings = []
+
+		leaders = {0}
+		for address, instruction in enumerate(program):
+			if instruction is None or instruction.opcode == Opcode.HALT:
+				leaders.add(address + 1)
+			elif instruction.opcode == Opcode.BR or instruction.opcode in BINARY_BRANCHES:
+				target = instruction.operand + 1
+				if target > len(program):
+					self.errors.append((address, f"Branch to {instruction.operand} is outside the program"))
+				else:
+					self.targets[address] = target
+					leaders.add(target)
+				leaders.add(address + 1)
+		starts = sorted(leader for leader in leaders if leader < len(program))
+		self.blocks = {}
+		for i, start in enumerate(starts):
+			self.blocks[start] = Block(start, starts[i + 1] if i + 1 < len(starts) else len(program))
+		for block in self.blocks.values():
+			for successor in self.__successors(block):
+				successor = successor if successor < len(program) else self.END
+				if successor not in block.successors:
+					block.successors.append(successor)
+					if successor != self.END:
+						self.blocks[successor].predecessors.append(block.start)
+
+		self.order = self.__reverse_postorder()
+		self.index = {start: i for i, start in enumerate(self.order)} # position in order
+		self.reachable = set(self.order)
+		self.idom = self.__dominators()
+		self.loops = self.__loops()
+		# Whether a block that can run off the end ever does depends on the
+		# registers, the interpreter still fails when one does
+		if not any(program[self.blocks[start].end - 1] is not None and program[self.blocks[start].end - 1].opcode == Opcode.HALT for start in self.order):
+			self.errors.append((len(program), "HALT instruction not found"))
+		for start in self.order:
+			if self.END in self.blocks[start].successors:
+				self.warnings.append((self.blocks[start].end - 1, "May run off the end of the program without a HALT"))
+		for start, block in self.blocks.items():
+			if start not in self.reachable:
+				for address in range(block.start, block.end):
+					instruction = program[address]
+					if instruction is not None and instruction.opcode not in (Opcode.NOP, Opcode.LABEL):
+						self.warnings.append((address, "Unreachable code"))
+						break
+
+	def __successors(self, block: Block) -> list[int]:
+		last = self.program[block.end - 1]
+		if last is None or last.opcode == Opcode.HALT:
+			return []
+		if last.opcode == Opcode.BR:
+			return [self.targets[block.end - 1]] if block.end - 1 in self.targets else []
+		if last.opcode in BINARY_BRANCHES and block.end - 1 in self.targets:
+			return [self.targets[block.end - 1], block.end]
+		return [block.end]
+
+	def __reverse_postorder(self) -> list[int]:
+		# Of the blocks reachable from address 0
+		if not self.blocks:
+			return []
+		order = []
+		visited = {0}
+		stack = [(0, iter(self.blocks[0].successors))]
+		while stack:
+			start, successors = stack[-1]
+			for successor in successors:
+				if successor != self.END and successor not in visited:
+					visited.add(successor)
+					stack.append((successor, iter(self.blocks[successor].successors)))
+					break
+			else:
+				stack.pop()
+				order.append(start)
+		order.reverse()
+		return order
+
+	def __dominators(self) -> dict[int, int]:
+		# Immediate dominator of every reachable block, by Cooper, Harvey
+		# and Kennedy's iterative algorithm. The entry block is its own.
+		if not self.order:
+			return {}
+		index = self.index
+		idom = {0: 0}
+		def intersect(a: int, b: int) -> int:
+			while a != b:
+				while index[a] > index[b]:
+					a = idom[a]
+				while index[b] > index[a]:
+					b = idom[b]
+			return a
+		changed = True
+		while changed:
+			changed = False
+			for start in self.order[1:]:
+				done = [predecessor for predecessor in self.blocks[start].predecessors if predecessor in idom]
+				dominator = done[0]
+				for predecessor in done[1:]:
+					dominator = intersect(predecessor, dominator)
+				if idom.get(start) != dominator:
+					idom[start] = dominator
+					changed = True
+		return idom
+
+	def dominates(self, a: int, b: int) -> bool:
+		# Whether every path from address 0 to block b goes through block a,
+		# both reachable blocks given by their start. Dominators come first in
+		# order, so the walk up from b stops once it passes a.
+		index = self.index[a]
+		while self.index[b] > index:
+			b = self.idom[b]
+		return b == a
+
+	def __loops(self) -> list[Loop]:
+		# One natural loop per block that a reachable block branches back to
+		loops = {}
+		for start in self.order:
+			for header in self.blocks[start].successors:
+				if header != self.END and self.dominates(header, start):
+					body = loops.setdefault(header, {header})
+					pending = [start]
+					while pending:
+						block = pending.pop()
+						if block not in body and block in self.reachable:
+							body.add(block)
+							pending.extend(self.blocks[block].predecessors)
+		return [Loop(header, body) for header, body in sorted(loops.items())]
+
+	def addresses(self, starts: Iterable[int]) -> Iterator[int]:
+		# Every address in the given blocks
+		for start in sorted(starts):
+			yield from range(start, self.blocks[start].end)
+
+
+class Compiler:
+	# Translates the whole loaded program into one generated Python function.
+	# Registers become locals and every basic block becomes a branch of a
+	# dispatch loop on ip, found by a binary search on the blocks' starts;
+	# a block that branches back to itself becomes an inner while loop.
+	# Steps are counted down a block at a time from the ones the function
+	# was given, and a block only starts if they cover all of it. When the generated code
+	# can't go on (the next block doesn't fit, it runs off the end of the
+	# program, or a STORE overwrites code) it writes the registers, ip and
+	# cycles back to memory and returns whether it can be called again,
+	# and the interpreter carries on from there. An instruction that fails
+	# writes them back too before raising.
+	DISPATCH_LEAF = 4 # blocks compared one by one at the end of the search
+
+	def __init__(self, memory: Memory, graph: 'ControlFlowGraph|None' = None):
+		# graph is the memory's code as it is now, if already built
+		self.memory = memory
+		self.graph = graph
+
+	def compile(self) -> Callable[[int|None], bool]:
+		if self.memory.clock == "async":
+			raise ValueError("The async clock is only supported by the interpret engine")
+		text = self.generate()
+		namespace = {"sleep": sleep, "SKIP_TIME": SKIP_TIME, "SKIP_TICKS": SKIP_TICKS, "Stop": Stop, "out_of_range": out_of_range, "line_addresses": self.line_addresses}
+		exec(compile(text, "<asm>", "exec"), namespace)
+		program = namespace["program"]
+		memory = self.memory
+		return lambda max_steps=None: program(memory, sys.maxsize if max_steps is None else max_steps)
+
+	def generate(self) -> str:
+		# Blocks that can't be reached aren't generated, if ip lands in one
+		# anyway the interpreter runs it
+		memory = self.memory
+		graph = self.graph or ControlFlowGraph(memory.get_val(address) for address in range(memory.program_size))
+		self.program = graph.program
+		self.targets = graph.targets
+		blocks = [graph.blocks[start] for start in sorted(graph.reachable)]
+
+		self.lines = []
+		# line of the generated code: address of the instruction it's from,
+		# instructions after it in its block
+		self.line_addresses = {}
+		self.__emit(0, "def program(memory, budget):")
+		self.__emit(1, "registers = memory.registers")
+		self.__emit(1, "status_registers = memory.status_registers")
+		self.__emit(1, "addresses = memory.addresses")
+		self.__emit(1, "disk = memory.disk")
+		self.__emit(1, "set_val = memory.set_val")
+		self.__emit(1, "get_val = memory.get_val")
+		self.__emit(1, "atomic = memory.atomic")
+		self.__emit(1, "block = memory.block")
+		self.__emit(1, "write = memory.output.write")
+		for slot, register in enumerate(REGISTERS):
+			self.__emit(1, f"{register} = registers[{slot}]")
+		self.__emit(1, "ip = status_registers['ip']")
+		self.__emit(1, "left = budget")
+		self.__emit(1, "try:")
+		self.__emit(2, "while True:")
+		if blocks:
+			self.__dispatch(3, blocks)
+		else:
+			self.__exit(3, "ip")
+		# Out of steps at the start of block ip
+		self.__emit(1, "except Stop:")
+		self.__sync(2)
+		self.__emit(2, "status_registers['cycles'] += budget - left")
+		self.__emit(2, "status_registers['ip'] = ip")
+		self.__emit(2, "return True")
+		# The registers are as the instructions before the failing one left
+		# them, and its address is found from the line that raised. It and
+		# the ones before it in its block count as steps.
+		self.__emit(1, "except Exception as e:")
+		self.__sync(2)
+		self.__emit(2, "address, unrun = line_addresses.get(e.__traceback__.tb_lineno, (ip, 0))")
+		self.__emit(2, "status_registers['cycles'] += budget - left - unrun")
+		self.__emit(2, "status_registers['ip'] = address")
+		self.__emit(2, "raise")
+		return "\n".join(self.lines) + "\n"
+
+	def __emit(self, depth: int, line: str):
+		self.lines.append("\t" * depth + line)
+
+	def __sync(self, depth: int):
+		for slot, register in enumerate(REGISTERS):
+			self.__emit(depth, f"registers[{slot}] = {register}")
+
+	def __exit(self, depth: int, ip: int|str, unrun: int = 0, resume: bool = True):
+		# unrun instructions at the end of the current block were counted
+		# but didn't run, resume is False once the program's code has changed
+		if unrun:
+			self.__emit(depth, f"left += {unrun}")
+		self.__sync(depth)
+		self.__emit(depth, "status_registers['cycles'] += budget - left")
+		self.__emit(depth, f"status_registers['ip'] = {ip}")
+		self.__emit(depth, f"return {resume}")
+
+	def __dispatch(self, depth: int, blocks: list[Block]):
+		# Halves blocks until a few are left to compare ip with one by one.
+		# A long elif chain would be nested too deep for Python to compile.
+		if len(blocks) > self.DISPATCH_LEAF:
+			middle = len(blocks) // 2
+			self.__emit(depth, f"if ip < {blocks[middle].start}:")
+			self.__dispatch(depth + 1, blocks[:middle])
+			self.__emit(depth, "else:")
+			self.__dispatch(depth + 1, blocks[middle:])
+			return
+		for i, block in enumerate(blocks):
+			self.__emit(depth, f"{'if' if i == 0 else 'elif'} ip == {block.start}:")
+			self.__block(depth + 1, block.start, block.end)
+		self.__emit(depth, "else:")
+		self.__exit(depth + 1, "ip")
+
+	def __block(self, depth: int, start: int, end: int):
+		self.end = end
+		last = self.program[end - 1]
+		self.__count(depth, end - start)
+		if last is None:
+			# Not an instruction, the interpreter fails on it
+			for address in range(start, end - 1):
+				self.__instruction(depth, address)
+			self.__exit(depth, end - 1, 1)
+			return
+		if last.opcode in BINARY_BRANCHES and self.targets[end - 1] == start:
+			self.__emit(depth, "while True:")
+			for address in range(start, end - 1):
+				self.__instruction(depth + 1, address)
+			self.__emit(depth + 1, f"if not ({self.__condition(last)}):")
+			self.__emit(depth + 2, "break")
+			self.__count(depth + 1, end - start)
+			self.__emit(depth, f"ip = {end}")
+			return
+		for address in range(start, end):
+			self.__instruction(depth, address)
+		if last.opcode == Opcode.HALT:
+			return
+		if last.opcode != Opcode.BR and last.opcode not in BINARY_BRANCHES:
+			self.__emit(depth, f"ip = {end}")
+
+	def __count(self, depth: int, n: int):
+		# Takes a run of the block from the steps left before it starts
+		self.__emit(depth, f"if (left := left - {n}) < 0:")
+		self.__emit(depth + 1, f"left += {n}")
+		self.__emit(depth + 1, "raise Stop")
+
+	def __condition(self, instruction: Instruction) -> str:
+		return f"{REGISTERS[instruction.ri]} {BINARY_BRANCHES[instruction.opcode]} {REGISTERS[instruction.rj]}"
+
+	def __operand(self, instruction: Instruction, address: int) -> str:
+		n = instruction.operand
+		match instruction.mode:
+			case Mode.DIRECT:
+				return f"addresses[{n - self.memory.starting_address}]"
+			case Mode.IMMEDIATE:
+				return f"{n}"
+			case Mode.INDEX:
+				return f"addresses[{self.__checked(f'{n} + {REGISTERS[instruction.rj]}')}]"
+			case Mode.INDIRECT:
+				return f"addresses[{self.__checked(f'addresses[{n}]')}]"
+			case Mode.RELATIVE:
+				return f"addresses[{address + n}]"
+
+	def __target(self, instruction: Instruction, address: int) -> str:
+		n = instruction.operand
+		match instruction.mode:
+			case Mode.DIRECT:
+				return f"{n}"
+			case Mode.INDEX:
+				return self.__checked(f"{n} + {REGISTERS[instruction.rj]}")
+			case Mode.RELATIVE:
+				return f"{address + n}"
+
+	def __checked(self, address: str) -> str:
+		# An address worked out at run time, failing if it is negative
+		return f"(index if (index := {address}) >= 0 else out_of_range(index))"
+
+	def __instruction(self, depth: int, address: int):
+		instruction = self.program[address]
+		# Registers are locals named after the register
+		ri = None if instruction.ri is None else REGISTERS[instruction.ri]
+		rj = None if instruction.rj is None else REGISTERS[instruction.rj]
+		first = len(self.lines) + 1
+		self.__code(depth, address, instruction, ri, rj)
+		for line in range(first, len(self.lines) + 1):
+			self.line_addresses[line] = (address, self.end - address - 1)
+
+	def __code(self, depth: int, address: int, instruction: Instruction, ri: str|None, rj: str|None):
+		match instruction.opcode:
+			case Opcode.NOP | Opcode.LABEL:
+				pass
+			case Opcode.LOAD:
+				self.__emit(depth, f"{ri} = {self.__operand(instruction, address)}")
+			case Opcode.STORE:
+				self.__emit(depth, f"target = {self.__target(instruction, address)}")
+				self.__emit(depth, f"set_val(target, {ri})")
+				# Overwrote code: let the interpreter re-decode it
+				self.__emit(depth, f"if 0 <= target < {len(self.program)}:")
+				self.__exit(depth + 1, address + 1, self.end - address - 1, False)
+			case Opcode.READ:
+				self.__emit(depth, f"{ri} = disk[{self.__target(instruction, address)}]")
+			case Opcode.WRITE:
+				self.__emit(depth, f"disk[{self.__target(instruction, address)}] = {ri}")
+			case Opcode.ADD:
+				self.__emit(depth, f"{ri} = {ri} + {rj}")
+			case Opcode.SUB:
+				self.__emit(depth, f"{ri} = {ri} - {rj}")
+			case Opcode.MUL:
+				self.__emit(depth, f"{ri} = {ri} * {rj}")
+			case Opcode.DIV:
+				self.__emit(depth, f"{ri}, {rj} = divmod({ri}, {rj})")
+			case Opcode.INC:
+				self.__emit(depth, f"{ri} = {ri} + 1")
+			case Opcode.BR:
+				self.__emit(depth, f"ip = {self.targets[address]}")
+			case Opcode.HALT:
+				self.__emit(depth, "status_registers['halt'] = 1")
+				self.__exit(depth, address + 1, self.end - address - 1)
+			case Opcode.SKIP:
+				self.__emit(depth, "status_registers['ticks'] += SKIP_TICKS")
+				if self.memory.clock == "real":
+					self.__emit(depth, "memory.output.flush()")
+					self.__emit(depth, "sleep(SKIP_TIME)")
+			case Opcode.PRINT:
+				if instruction.mode == Mode.DIRECT:
+					n = instruction.operand
+					self.__emit(depth, f"write(f'M[{n}]: {{addresses[{n}]}}\\n')")
+				else:
+					self.__emit(depth, f"write(f'{ri}: {{{ri}}}\\n')")
+			case Opcode.DUMP:
+				self.__sync(depth)
+				self.__emit(depth, "memory.dump()")
+			case Opcode.CAS:
+				self.__emit(depth, f"target = {self.__target(instruction, address)}")
+				self.__emit(depth, "with atomic:")
+				self.__emit(depth + 1, "old = get_val(target)")
+				self.__emit(depth + 1, f"swapped = old == {ri}")
+				self.__emit(depth + 1, "if swapped:")
+				self.__emit(depth + 2, f"set_val(target, {rj})")
+				self.__emit(depth, f"{rj} = old")
+				self.__emit(depth, f"if swapped and 0 <= target < {len(self.program)}:")
+				self.__exit(depth + 1, address + 1, self.end - address - 1, False)
+			case Opcode.FAA:
+				self.__emit(depth, f"target = {self.__target(instruction, address)}")
+				self.__emit(depth, "with atomic:")
+				self.__emit(depth + 1, "old = get_val(target)")
+				self.__emit(depth + 1, f"set_val(target, old + {ri})")
+				self.__emit(depth, f"{ri} = old")
+				self.__emit(depth, f"if 0 <= target < {len(self.program)}:")
+				self.__exit(depth + 1, address + 1, self.end - address - 1, False)
+			case Opcode.CPUID:
+				self.__emit(depth, f"{ri} = {self.memory.cpu}")
+			case opcode if opcode in BLOCK_OPCODES:
+				count = REGISTERS[instruction.operand] if instruction.mode == Mode.REGISTER else instruction.operand
+				call = f"block({int(opcode)}, {ri}, {rj}, {count})"
+				if opcode in BLOCK_RESULTS:
+					self.__emit(depth, f"{ri} = {call}")
+				else:
+					self.__emit(depth, call)
+				if opcode in BLOCK_MEMORY_WRITES:
+					self.__emit(depth, f"if max({ri}, 0) < min({ri} + {count}, {len(self.program)}):")
+					self.__exit(depth + 1, address + 1, self.end - address - 1, False)
+			case _:
+				self.__emit(depth, f"ip = {self.targets[address]} if {self.__condition(instruction)} else {address + 1}")
 		
 
-if len(argv) != 2:
-	print("Usage: asm.py FILENAME")
-	exit(EXT_ERR_BAD_ARGUMENTS)
+class Handler(IntEnum):
+	# What a ThreadedCode record runs. Addressing modes are picked when
+	# translating, so there is a handler per mode that needs different code.
+	NOP = 0
+	LOAD = auto() # from a fixed address
+	LOAD_IMMEDIATE = auto()
+	LOAD_INDEX = auto()
+	LOAD_INDIRECT = auto()
+	STORE = auto() # to a fixed address
+	STORE_INDEX = auto()
+	READ = auto() # from a fixed disk address
+	READ_INDEX = auto()
+	WRITE = auto()
+	WRITE_INDEX = auto()
+
+	ADD = auto()
+	SUB = auto()
+	MUL = auto()
+	DIV = auto()
+	INC = auto()
+
+	BR = auto()
+	BLT = auto()
+	BGT = auto()
+	BLEQ = auto()
+	BGEQ = auto()
+	BEQ = auto()
+	BNEQ = auto()
+
+	HALT = auto()
+	SKIP = auto()
+	PRINT = auto() # a memory word
+	PRINT_REGISTER = auto()
+	DUMP = auto()
+
+	CAS = auto()
+	FAA = auto()
+	FAA_INDEX = auto()
+	CPUID = auto()
+
+	# n is the count, or ~slot of the register holding it
+	MCOPY = auto()
+	MFILL = auto()
+	MSUM = auto()
+	MCMP = auto()
+	DCOPY = auto()
+	DFILL = auto()
+	DSUM = auto()
+	DCMP = auto()
+	BREAD = auto()
+	BWRITE = auto()
+
+	INVALID = auto() # a word that isn't an instruction
+	END = auto() # past the end of the program
+
+
+class Stop(Exception):
+	# Raised by a handler once its instruction has halted or suspended the machine
+	pass
+
+
+class ThreadedCode:
+	# Execution engine that translates every instruction once into a record
+	# of ints, (handler, ri, rj, n), and runs the records with a dispatch
+	# loop that keeps ip in a local and calls handlers[handler] for each.
+	# Addresses and branch targets are worked out when translating, n holds
+	# whichever the handler needs, and handlers return the next ip. A
+	# store to code translates the overwritten record again.
+	#
+	# Handlers are closures over the register list, memory and disk, built
+	# again whenever memory or disk has been replaced, by sharing or
+	# restoring, since the last fde_cycle.
+	def __init__(self, memory: Memory):
+		self.memory = memory
+		self.code = [self.__record(address) for address in range(memory.program_size)] + [(Handler.END, 0, 0, 0)]
+		self.handlers = None
+		self.storage = None # the memory and disk the handlers were built for
+
+	def __record(self, address: int) -> tuple[int, int, int, int]:
+		# address is less starting_address, like ip in fde_cycle
+		start = self.memory.starting_address
+		try:
+			instruction = decode_instruction(self.memory.addresses[address])
+		except ValueError:
+			return (Handler.INVALID, 0, 0, 0)
+		opcode = instruction.opcode
+		mode = instruction.mode
+		ri = instruction.ri or 0
+		rj = instruction.rj or 0
+		n = instruction.operand
+		match opcode:
+			case Opcode.NOP | Opcode.LABEL:
+				return (Handler.NOP, 0, 0, 0)
+			case Opcode.LOAD:
+				match mode:
+					case Mode.DIRECT:
+						return (Handler.LOAD, ri, 0, n - start)
+					case Mode.IMMEDIATE:
+						return (Handler.LOAD_IMMEDIATE, ri, 0, n)
+					case Mode.INDEX:
+						return (Handler.LOAD_INDEX, ri, rj, n)
+					case Mode.INDIRECT:
+						return (Handler.LOAD_INDIRECT, ri, 0, n)
+					case Mode.RELATIVE:
+						return (Handler.LOAD, ri, 0, address + start + n)
+			case Opcode.STORE | Opcode.FAA | Opcode.CAS:
+				match mode:
+					case Mode.DIRECT:
+						return (Handler[opcode.name], ri, rj, n - start)
+					case Mode.RELATIVE:
+						return (Handler[opcode.name], ri, rj, address + n)
+					case Mode.INDEX if opcode != Opcode.CAS:
+						return (Handler.STORE_INDEX if opcode == Opcode.STORE else Handler.FAA_INDEX, ri, rj, n - start)
+			case Opcode.READ | Opcode.WRITE:
+				if mode == Mode.INDEX:
+					return (Handler[f"{opcode.name}_INDEX"], ri, rj, n)
+				return (Handler[opcode.name], ri, 0, n)
+			case Opcode.BR:
+				return (Handler.BR, 0, 0, n + 1 - start)
+			case Opcode.PRINT:
+				if mode == Mode.DIRECT:
+					return (Handler.PRINT, 0, 0, n)
+				return (Handler.PRINT_REGISTER, ri, 0, 0)
+			case _ if opcode in BINARY_BRANCHES:
+				return (Handler[opcode.name], ri, rj, n + 1 - start)
+			case _ if opcode in BLOCK_OPCODES:
+				return (Handler[opcode.name], ri, rj, n if mode == Mode.IMMEDIATE else ~n)
+			case _:
+				return (Handler[opcode.name], ri, rj, 0)
+		# A mode the instruction can't have, the interpreter fails on it too
+		return (Handler.INVALID, 0, 0, 0)
+
+	def __handlers(self) -> list[Callable[[int, int, int, int], int]]:
+		memory = self.memory
+		registers = memory.registers
+		status_registers = memory.status_registers
+		addresses = memory.addresses
+		disk = memory.disk
+		atomic = memory.atomic
+		write = memory.output.write
+		code = self.code
+		record = self.__record
+		size = memory.program_size
+		start = memory.starting_address
+		cpu = memory.cpu
+
+		def nop(ri, rj, n, ip):
+			return ip + 1
+		def load(ri, rj, n, ip):
+			registers[ri] = addresses[n]
+			return ip + 1
+		def load_immediate(ri, rj, n, ip):
+			registers[ri] = n
+			return ip + 1
+		def load_index(ri, rj, n, ip):
+			target = n + registers[rj]
+			if target < 0:
+				out_of_range(target)
+			registers[ri] = addresses[target]
+			return ip + 1
+		def load_indirect(ri, rj, n, ip):
+			target = addresses[n]
+			if target < 0:
+				out_of_range(target)
+			registers[ri] = addresses[target]
+			return ip + 1
+		def store(ri, rj, n, ip):
+			addresses[n] = registers[ri]
+			if 0 <= n < size:
+				code[n] = record(n)
+			return ip + 1
+		def store_index(ri, rj, n, ip):
+			target = n + registers[rj]
+			if target < 0:
+				out_of_range(target)
+			return store(ri, rj, target, ip)
+		def read(ri, rj, n, ip):
+			registers[ri] = disk[n]
+			return ip + 1
+		def read_index(ri, rj, n, ip):
+			target = n + registers[rj]
+			if target < 0:
+				out_of_range(target)
+			registers[ri] = disk[target]
+			return ip + 1
+		def write_disk(ri, rj, n, ip):
+			disk[n] = registers[ri]
+			return ip + 1
+		def write_index(ri, rj, n, ip):
+			target = n + registers[rj]
+			if target < 0:
+				out_of_range(target)
+			disk[target] = registers[ri]
+			return ip + 1
+
+		def add(ri, rj, n, ip):
+			registers[ri] = registers[ri] + registers[rj]
+			return ip + 1
+		def sub(ri, rj, n, ip):
+			registers[ri] = registers[ri] - registers[rj]
+			return ip + 1
+		def mul(ri, rj, n, ip):
+			registers[ri] = registers[ri] * registers[rj]
+			return ip + 1
+		def div(ri, rj, n, ip):
+			registers[ri], registers[rj] = divmod(registers[ri], registers[rj])
+			return ip + 1
+		def inc(ri, rj, n, ip):
+			registers[ri] = registers[ri] + 1
+			return ip + 1
+
+		def br(ri, rj, n, ip):
+			return n
+		def blt(ri, rj, n, ip):
+			return n if registers[ri] < registers[rj] else ip + 1
+		def bgt(ri, rj, n, ip):
+			return n if registers[ri] > registers[rj] else ip + 1
+		def bleq(ri, rj, n, ip):
+			return n if registers[ri] <= registers[rj] else ip + 1
+		def bgeq(ri, rj, n, ip):
+			return n if registers[ri] >= registers[rj] else ip + 1
+		def beq(ri, rj, n, ip):
+			return n if registers[ri] == registers[rj] else ip + 1
+		def bneq(ri, rj, n, ip):
+			return n if registers[ri] != registers[rj] else ip + 1
+
+		def halt(ri, rj, n, ip):
+			status_registers["halt"] = 1
+			raise Stop
+		match memory.clock:
+			case "real":
+				flush = memory.output.flush
+				def skip(ri, rj, n, ip):
+					status_registers["ticks"] += SKIP_TICKS
+					flush()
+					sleep(SKIP_TIME)
+					return ip + 1
+			case "simulated":
+				def skip(ri, rj, n, ip):
+					status_registers["ticks"] += SKIP_TICKS
+					return ip + 1
+			case "async":
+				def skip(ri, rj, n, ip):
+					status_registers["ticks"] += SKIP_TICKS
+					status_registers["halt"] = SUSPENDED
+					raise Stop
+		def print_memory(ri, rj, n, ip):
+			write(f"M[{n}]: {addresses[n]}\n")
+			return ip + 1
+		def print_register(ri, rj, n, ip):
+			write(f"{REGISTERS[ri]}: {registers[ri]}\n")
+			return ip + 1
+		def dump(ri, rj, n, ip):
+			memory.dump()
+			return ip + 1
+
+		def cas(ri, rj, n, ip):
+			with atomic:
+				old = addresses[n]
+				if old == registers[ri]:
+					addresses[n] = registers[rj]
+					if 0 <= n < size:
+						code[n] = record(n)
+			registers[rj] = old
+			return ip + 1
+		def faa(ri, rj, n, ip):
+			with atomic:
+				old = addresses[n]
+				addresses[n] = old + registers[ri]
+				if 0 <= n < size:
+					code[n] = record(n)
+			registers[ri] = old
+			return ip + 1
+		def faa_index(ri, rj, n, ip):
+			target = n + registers[rj]
+			if target < 0:
+				out_of_range(target)
+			return faa(ri, rj, target, ip)
+		def cpuid(ri, rj, n, ip):
+			registers[ri] = cpu
+			return ip + 1
+
+		block = memory.block
+		def block_result(opcode):
+			def lambda_(ri, rj, n, ip):
+				registers[ri] = block(opcode, registers[ri], registers[rj], n if n >= 0 else registers[~n])
+				return ip + 1
+			return lambda_
+		def block_disk(opcode):
+			def lambda_(ri, rj, n, ip):
+				block(opcode, registers[ri], registers[rj], n if n >= 0 else registers[~n])
+				return ip + 1
+			return lambda_
+		def block_memory(opcode):
+			# Writes count words from the address in ri, some may be code
+			def lambda_(ri, rj, n, ip):
+				count = n if n >= 0 else registers[~n]
+				target = registers[ri] - start
+				block(opcode, registers[ri], registers[rj], count)
+				for address in range(max(target, 0), min(target + count, size)):
+					code[address] = record(address)
+				return ip + 1
+			return lambda_
+		mcopy, mfill, bread = map(block_memory, (Opcode.MCOPY, Opcode.MFILL, Opcode.BREAD))
+		msum, mcmp, dsum, dcmp = map(block_result, (Opcode.MSUM, Opcode.MCMP, Opcode.DSUM, Opcode.DCMP))
+		dcopy, dfill, bwrite = map(block_disk, (Opcode.DCOPY, Opcode.DFILL, Opcode.BWRITE))
+
+		def invalid(ri, rj, n, ip):
+			# Fails the way decoding it in the interpreter does
+			decode_instruction(addresses[ip])
+		def end(ri, rj, n, ip):
+			status_registers["ip"] = ip + start
+			memory.error("HALT instruction not found")
+
+		if memory.clock == "async":
+			# I/O suspends the machine afterwards, like Executor.__awaiting
+			def suspending(handler):
+				def lambda_(ri, rj, n, ip):
+					handler(ri, rj, n, ip)
+					status_registers["halt"] = SUSPENDED
+					raise Stop
+				return lambda_
+			print_memory, print_register, dump = map(suspending, (print_memory, print_register, dump))
+			if memory.disk_file is not None:
+				read, read_index, write_disk, write_index = map(suspending, (read, read_index, write_disk, write_index))
+				dcopy, dfill, dsum, dcmp, bread, bwrite = map(suspending, (dcopy, dfill, dsum, dcmp, bread, bwrite))
+
+		handlers = {
+			Handler.NOP: nop,
+			Handler.LOAD: load,
+			Handler.LOAD_IMMEDIATE: load_immediate,
+			Handler.LOAD_INDEX: load_index,
+			Handler.LOAD_INDIRECT: load_indirect,
+			Handler.STORE: store,
+			Handler.STORE_INDEX: store_index,
+			Handler.READ: read,
+			Handler.READ_INDEX: read_index,
+			Handler.WRITE: write_disk,
+			Handler.WRITE_INDEX: write_index,
+			Handler.ADD: add,
+			Handler.SUB: sub,
+			Handler.MUL: mul,
+			Handler.DIV: div,
+			Handler.INC: inc,
+			Handler.BR: br,
+			Handler.BLT: blt,
+			Handler.BGT: bgt,
+			Handler.BLEQ: bleq,
+			Handler.BGEQ: bgeq,
+			Handler.BEQ: beq,
+			Handler.BNEQ: bneq,
+			Handler.HALT: halt,
+			Handler.SKIP: skip,
+			Handler.PRINT: print_memory,
+			Handler.PRINT_REGISTER: print_register,
+			Handler.DUMP: dump,
+			Handler.CAS: cas,
+			Handler.FAA: faa,
+			Handler.FAA_INDEX: faa_index,
+			Handler.CPUID: cpuid,
+			Handler.MCOPY: mcopy,
+			Handler.MFILL: mfill,
+			Handler.MSUM: msum,
+			Handler.MCMP: mcmp,
+			Handler.DCOPY: dcopy,
+			Handler.DFILL: dfill,
+			Handler.DSUM: dsum,
+			Handler.DCMP: dcmp,
+			Handler.BREAD: bread,
+			Handler.BWRITE: bwrite,
+			Handler.INVALID: invalid,
+			Handler.END: end,
+		}
+		return [handlers[handler] for handler in Handler]
+
+	def fde_cycle(self, max_steps: int|None = None) -> int:
+		# Same as Memory.fde_cycle
+		memory = self.memory
+		if self.storage is None or self.storage[0] is not memory.addresses or self.storage[1] is not memory.disk:
+			self.handlers = self.__handlers()
+			self.storage = (memory.addresses, memory.disk)
+		handlers = self.handlers
+		code = self.code
+		status_registers = memory.status_registers
+		start = memory.starting_address
+		ip = status_registers["ip"] - start
+		steps = 0
+		try:
+			for steps in count(1) if max_steps is None else range(1, max_steps + 1):
+				handler, ri, rj, n = code[ip]
+				ip = handlers[handler](ri, rj, n, ip)
+		except Stop:
+			ip += 1
+		finally:
+			status_registers["ip"] = ip + start
+			status_registers["cycles"] += steps
+		return steps
+
+
+class Optimizer:
+	# Peephole pass over the loaded program for the interpret engine. The
+	# program's words are left as they are, since programs can read and
+	# DUMP them; instead the decode cache gets one closure per straight run
+	# of register instructions, generated with constants folded, INCs
+	# merged and unconditional branches followed. A run may start with a
+	# LOAD, READ or DIV, which can fail while ip still points at it, and end
+	# with a compare-and-branch or HALT. Code that can't be reached isn't
+	# decoded. Memory.weights keeps how many instructions a fused closure
+	# stands for so steps and limits don't change, and a write to any
+	# address a fused closure read unfuses it.
+	COMPARISONS = {
+		Opcode.BLT: lt,
+		Opcode.BGT: gt,
+		Opcode.BLEQ: le,
+		Opcode.BGEQ: ge,
+		Opcode.BEQ: eq,
+		Opcode.BNEQ: ne,
+	}
+
+	def __init__(self, memory: Memory, graph: 'ControlFlowGraph|None' = None):
+		# graph is the memory's code as it is now, if already built
+		self.memory = memory
+		self.graph = graph
+		self.stats = {"fused": 0, "dead": 0}
+
+	def optimize(self) -> int:
+		# Returns how many instructions were eliminated
+		memory = self.memory
+		graph = self.graph or ControlFlowGraph(memory.get_val(address) for address in range(memory.program_size))
+		program = self.program = graph.program
+		reachable = set(graph.addresses(graph.reachable))
+		entries = {0} | {target for address, target in graph.targets.items() if address in reachable}
+
+		self.lines = []
+		runs = {}
+		covered = set()
+		for address in sorted(reachable):
+			if address in covered and address not in entries:
+				continue
+			run = self.__fuse(address)
+			if run is not None:
+				runs[address] = run
+				covered.update(run[1:])
+
+		namespace = {"memory": memory, "registers": memory.registers, "status_registers": memory.status_registers, "out_of_range": out_of_range}
+		exec(compile("\n".join(self.lines) + "\n", "<optimized>", "exec"), namespace)
+		memory.weights = [1] * len(memory.decoded)
+		for head, run in runs.items():
+			memory.decoded[head] = namespace[f"fused_{head}"]
+			memory.weights[head] = len(run)
+			for address in run:
+				memory.fused.setdefault(address, []).append(head)
+
+		self.stats["fused"] = len(covered - entries - runs.keys())
+		self.stats["dead"] = sum(
+			1 for address, instruction in enumerate(program)
+			if address not in reachable and instruction is not None and instruction.opcode not in (Opcode.NOP, Opcode.LABEL)
+		)
+		return self.stats["fused"] + self.stats["dead"]
+
+	def __fuse(self, head: int) -> list[int]|None:
+		# Generates fused_{head} and returns the addresses it executes, in
+		# order, or None if there is nothing to fuse. Registers are read
+		# into locals named after them when first needed and written back
+		# at the end, so until then registers holds the values at the start.
+		program = self.program
+		self.constants = {} # slot: value known at this point
+		self.offsets = {}   # slot: amount still to be added to its local
+		self.loaded = set()
+		self.body = []
+		written = set()
+		run = []
+		address = head
+		end = None # statements that leave the run, if it ends on a branch or HALT
+		while 0 <= address < len(program) and address not in run:
+			instruction = program[address]
+			if instruction is None:
+				break
+			opcode = instruction.opcode
+			ri = instruction.ri
+			rj = instruction.rj
+			match opcode:
+				case Opcode.NOP | Opcode.LABEL:
+					pass
+				case Opcode.LOAD if instruction.mode == Mode.IMMEDIATE:
+					self.__set(ri, instruction.operand)
+					written.add(ri)
+				case Opcode.LOAD if not run:
+					self.__assign(ri, self.__operand(instruction, address))
+					written.add(ri)
+				case Opcode.READ if not run and self.memory.clock != "async":
+					index = instruction.operand if instruction.mode == Mode.DIRECT else f"index if (index := {instruction.operand} + {self.__value(rj)}) >= 0 else out_of_range(index)"
+					self.__assign(ri, f"memory.disk[{index}]")
+					written.add(ri)
+				case Opcode.INC:
+					self.__add(ri, 1)
+					written.add(ri)
+				case Opcode.ADD | Opcode.SUB if rj in self.constants:
+					self.__add(ri, self.constants[rj] if opcode == Opcode.ADD else -self.constants[rj])
+					written.add(ri)
+				case Opcode.ADD if ri in self.constants:
+					# ri = rj + constant
+					constant = self.constants[ri]
+					self.__assign(ri, self.__value(rj))
+					self.offsets[ri] = constant
+					written.add(ri)
+				case Opcode.MUL if ri in self.constants and rj in self.constants:
+					self.__set(ri, self.constants[ri] * self.constants[rj])
+					written.add(ri)
+				case Opcode.ADD | Opcode.SUB | Opcode.MUL:
+					symbol = {Opcode.ADD: "+", Opcode.SUB: "-", Opcode.MUL: "*"}[opcode]
+					self.__assign(ri, f"{self.__value(ri)} {symbol} {self.__value(rj)}")
+					written.add(ri)
+				case Opcode.DIV if ri in self.constants and self.constants.get(rj, 0) != 0:
+					quotient, remainder = divmod(self.constants[ri], self.constants[rj])
+					self.__set(ri, quotient)
+					self.__set(rj, remainder)
+					written.update((ri, rj))
+				case Opcode.DIV if self.constants.get(rj, 0) != 0 or not run:
+					division = f"divmod({self.__value(ri)}, {self.__value(rj)})"
+					for slot in (ri, rj):
+						self.constants.pop(slot, None)
+						self.offsets.pop(slot, None)
+						self.loaded.add(slot)
+					self.body.append(f"{REGISTERS[ri]}, {REGISTERS[rj]} = {division}")
+					written.update((ri, rj))
+				case Opcode.BR:
+					# Followed to its target
+					run.append(address)
+					address = instruction.operand + 1
+					continue
+				case _ if opcode in BINARY_BRANCHES:
+					run.append(address)
+					target = instruction.operand + 1
+					if ri in self.constants and rj in self.constants:
+						taken = self.COMPARISONS[opcode](self.constants[ri], self.constants[rj])
+						address = target if taken else address + 1
+						continue
+					condition = f"{self.__value(ri)} {BINARY_BRANCHES[opcode]} {self.__value(rj)}"
+					end = [f"status_registers['ip'] = {instruction.operand} if {condition} else {address}"]
+					break
+				case Opcode.HALT:
+					run.append(address)
+					end = ["status_registers['halt'] = 1", f"status_registers['ip'] = {address}"]
+					break
+				case _:
+					break
+			run.append(address)
+			address += 1
+		if len(run) < 2:
+			return None
+
+		for slot in sorted(written):
+			self.body.append(f"registers[{slot}] = {self.__value(slot)}")
+		self.lines.append(f"def fused_{head}():")
+		self.lines.extend(f"\t{line}" for line in self.body + (end or [f"status_registers['ip'] = {address - 1}"]))
+		return run
+
+	def __value(self, slot: int) -> str:
+		# Expression for the register's current value
+		if slot in self.constants:
+			return str(self.constants[slot])
+		register = REGISTERS[slot]
+		if slot not in self.loaded:
+			self.body.append(f"{register} = registers[{slot}]")
+			self.loaded.add(slot)
+		offset = self.offsets.get(slot, 0)
+		return f"({register} + {offset})" if offset else register
+
+	def __set(self, slot: int, value: int):
+		self.constants[slot] = value
+		self.offsets.pop(slot, None)
+
+	def __assign(self, slot: int, expression: str):
+		self.body.append(f"{REGISTERS[slot]} = {expression}")
+		self.constants.pop(slot, None)
+		self.offsets.pop(slot, None)
+		self.loaded.add(slot)
+
+	def __add(self, slot: int, amount: int):
+		if slot in self.constants:
+			self.constants[slot] += amount
+		else:
+			self.offsets[slot] = self.offsets.get(slot, 0) + amount
+
+	def __operand(self, instruction: Instruction, address: int) -> str:
+		# The same reads as Executor's LOAD
+		n = instruction.operand
+		match instruction.mode:
+			case Mode.DIRECT:
+				return f"memory.get_val({n})"
+			case Mode.INDEX:
+				return f"memory.get_val({n} + {self.__value(instruction.rj)})"
+			case Mode.INDIRECT:
+				return f"memory.get_val(memory.get_val({n}))"
+			case Mode.RELATIVE:
+				return f"memory.addresses[{address + n}]"
+
+
+class Profiler:
+	# Execution counts per code address, filled in by Memory.fde_cycle.
+	# Everything else (opcodes, labels, branches) is derived from them when
+	# reporting, so profiling adds two list updates per instruction.
+	def __init__(self, memory: Memory, graph: 'ControlFlowGraph|None' = None):
+		# graph is the code being profiled, if already built
+		self.memory = memory
+		self.graph = graph
+		self.counts = [0] * (memory.program_size + 1)
+		self.jumps = [0] * (memory.program_size + 1)
+
+	def to_dict(self) -> dict:
+		graph = self.graph or ControlFlowGraph(self.memory.get_val(address) for address in range(self.memory.program_size))
+		program = graph.program
+		labels = {address: label for label, address in self.memory.label_table.items()}
+		total = sum(self.counts)
+		addresses = []
+		opcodes = {}
+		regions = {}
+		branches = []
+		region = "<start>"
+		for address, instruction in enumerate(program):
+			region = labels.get(address, region)
+			count = self.counts[address]
+			if count == 0:
+				continue
+			text = disassemble(instruction, address, labels)
+			addresses.append({"address": address, "instruction": text, "count": count})
+			opcodes[instruction.opcode.name] = opcodes.get(instruction.opcode.name, 0) + count
+			regions[region] = regions.get(region, 0) + count
+			if instruction.opcode in BINARY_BRANCHES:
+				branches.append({
+					"address": address,
+					"instruction": text,
+					"taken": self.jumps[address],
+					"not_taken": count - self.jumps[address],
+				})
+		addresses.sort(key=lambda entry: entry["count"], reverse=True)
+		loops = []
+		for loop in graph.loops:
+			count = sum(self.counts[address] for address in graph.addresses(loop.blocks))
+			if count:
+				loops.append({
+					"address": loop.header,
+					"label": labels.get(loop.header - 1, str(loop.header)),
+					"iterations": self.counts[loop.header],
+					"count": count,
+				})
+		loops.sort(key=lambda entry: entry["count"], reverse=True)
+		return {
+			"steps": total,
+			"addresses": addresses,
+			"opcodes": dict(sorted(opcodes.items(), key=lambda item: item[1], reverse=True)),
+			"labels": dict(sorted(regions.items(), key=lambda item: item[1], reverse=True)),
+			"branches": branches,
+			"loops": loops,
+		}
+
+	def report(self, top: int = 10) -> str:
+		profile = self.to_dict()
+		total = profile["steps"] or 1
+		lines = [f"Profile: {profile['steps']} instructions executed", "", "Hot spots:"]
+		for entry in profile["addresses"][:top]:
+			lines.append(f"  {entry['count']:>10} {entry['count'] / total:>7.1%}  {entry['address']:>6}  {entry['instruction']}")
+		lines += ["", "Opcodes:"]
+		for name, count in profile["opcodes"].items():
+			lines.append(f"  {count:>10} {count / total:>7.1%}  {name}")
+		lines += ["", "Labels:"]
+		for name, count in profile["labels"].items():
+			lines.append(f"  {count:>10} {count / total:>7.1%}  {name}")
+		if profile["branches"]:
+			lines += ["", "Branches:"]
+			for entry in profile["branches"]:
+				executed = entry["taken"] + entry["not_taken"]
+				lines.append(f"  {entry['taken']:>10} taken {entry['not_taken']:>10} not taken {entry['taken'] / executed:>7.1%}  {entry['address']:>6}  {entry['instruction']}")
+		if profile["loops"]:
+			lines += ["", "Loops:"]
+			for entry in profile["loops"]:
+				lines.append(f"  {entry['count']:>10} {entry['count'] / total:>7.1%}  {entry['address']:>6}  {entry['label']} ({entry['iterations']} iterations)")
+		return "\n".join(lines)
+
+
+# Kinds of journal entries
+WRITE_MEMORY = 0
+WRITE_DISK = 1
+
+# Trace files: a header, then one record per step made of the step header,
+# the registers that changed and the memory and disk writes. Values are
+# stored as 64 bit words.
+TRACE_MAGIC = b"ASMT"
+TRACE_VERSION = 2
+TRACE_HEADER = Struct("<4sHQ") # magic, version, step number of the first record
+TRACE_STEP = Struct("<QBBI") # ip, opcode, changed registers, writes, a block instruction makes many
+TRACE_REGISTER = Struct("<Bq") # slot, new value
+TRACE_WRITE = Struct("<BQq") # kind, address, new value
+WORD_MASK = (1 << 64) - 1
+
+
+def to_word(value: int) -> int:
+	value &= WORD_MASK
+	return value - (1 << 64) if value >> 63 else value
 
-filename = Path(argv[1])
 
-if not filename.is_file():
-	print(f"{filename} is not a file")
-	exit(EXT_ERR_NOT_A_FILE)
+@dataclass
+class TraceStep:
+	step: int
+	ip: int
+	opcode: Opcode
+	registers: list[tuple[int, int]] # (slot, new value)
+	writes: list[tuple[int, int, int]] # (kind, address, new value)
+
+
+class Tracer:
+	# Packs one record per step into a buffer that is written out in large
+	# chunks. With ring set only the last ring steps are kept, in memory,
+	# and written when the tracer is closed. journal is the list the
+	# Executor appends memory and disk writes to.
+	def __init__(self, path: Path, journal: list, ring: int|None = None, buffer_size: int = 1 << 20):
+		self.path = path
+		self.ring = None if ring is None else deque(maxlen=ring)
+		self.buffer = bytearray()
+		self.buffer_size = buffer_size
+		self.journal = journal
+		self.steps = 0
+		self.file = None
+		if self.ring is None:
+			self.file = open(path, "wb")
+			self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, 0))
+
+	def record(self, ip: int, opcode: int, before: list[int], after: list[int]):
+		changed = [(slot, value) for slot, value in enumerate(after) if value != before[slot]]
+		journal = self.journal
+		record = bytearray(TRACE_STEP.pack(ip, opcode, len(changed), len(journal)))
+		for slot, value in changed:
+			record += TRACE_REGISTER.pack(slot, to_word(value))
+		for kind, address, old, new in journal:
+			record += TRACE_WRITE.pack(kind, address, to_word(new))
+		self.steps += 1
+		if self.ring is not None:
+			self.ring.append(bytes(record))
+			return
+		self.buffer += record
+		if len(self.buffer) >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		if self.file is not None:
+			self.file.write(self.buffer)
+			self.buffer.clear()
+
+	def close(self):
+		if self.ring is not None:
+			with open(self.path, "wb") as f:
+				f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.steps - len(self.ring)))
+				f.write(b"".join(self.ring))
+			self.ring.clear()
+		elif self.file is not None:
+			self.flush()
+			self.file.close()
+			self.file = None
+
+
+def read_trace(path: Path) -> Iterator[TraceStep]:
+	# The trace is mapped rather than read so long traces aren't loaded whole
+	with open(path, "rb") as f, mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+		magic, version, step = TRACE_HEADER.unpack_from(data)
+		if magic != TRACE_MAGIC or version != TRACE_VERSION:
+			raise ValueError(f"{path} is not a version {TRACE_VERSION} trace")
+		offset = TRACE_HEADER.size
+		while offset < len(data):
+			ip, opcode, changed, writes = TRACE_STEP.unpack_from(data, offset)
+			offset += TRACE_STEP.size
+			registers = []
+			for _ in range(changed):
+				registers.append(TRACE_REGISTER.unpack_from(data, offset))
+				offset += TRACE_REGISTER.size
+			memory_writes = []
+			for _ in range(writes):
+				memory_writes.append(TRACE_WRITE.unpack_from(data, offset))
+				offset += TRACE_WRITE.size
+			yield TraceStep(step, ip, Opcode(opcode), registers, memory_writes)
+			step += 1
 
-with open(filename, "r") as f:
-	lines = f.readlines()
 
-memory = Memory()
-scanner = Scanner(memory, lines)	
-parser = Parser(memory)
-memory.load(lines)
-memory.fde_cycle(scanner, parser)
+@dataclass
+class Snapshot:
+	step: int
+	memory: list[bytes] # chunks of words
+	disk: list[bytes]
+	changed: tuple[set[int], set[int]] # memory and disk chunks written since the previous snapshot
+
+
+class History:
+	# Records a run so it can be moved back and forth through. Every step
+	# keeps the ip and registers it started with and the writes it made,
+	# and every interval steps memory and disk are snapshotted. Snapshots
+	# are copy on write: only chunks written since the previous snapshot
+	# are copied, the others are shared with it. Going to a step restores
+	# the nearest snapshot and replays at most interval steps from it.
+	# Only the last max_snapshots snapshots and the steps after the oldest
+	# of them are kept. Output isn't replayed.
+	CHUNK = 512 # words
+
+	def __init__(self, memory: Memory, journal: list, interval: int = 1000, max_snapshots: int = 16):
+		if not isinstance(memory.mmu, FlatMMU):
+			raise ValueError("History needs flat memory")
+		self.memory = memory
+		self.journal = journal
+		self.interval = interval
+		self.max_snapshots = max_snapshots
+		self.snapshots = deque()
+		self.entries = [] # (ip, ticks, registers, writes) for every step from start to end
+		self.start = 0
+		self.step = 0
+		self.final = None # registers and status at end, saved when leaving it
+		self.ticks = memory.status_registers["ticks"] # before the next recorded step
+		self.cycles = memory.status_registers["cycles"] # at step 0
+		self.dirty = (set(), set())
+		self.__snapshot()
+
+	@property
+	def end(self) -> int:
+		return self.start + len(self.entries)
+
+	def record(self, ip: int, opcode: int, before: list[int], after: list[int]):
+		if self.step != self.end:
+			self.__truncate()
+		writes = tuple(self.journal)
+		offset = self.memory.starting_address
+		for kind, address, old, new in writes:
+			self.dirty[kind].add((address - offset if kind == WRITE_MEMORY else address) // self.CHUNK)
+		self.entries.append((ip, self.ticks, tuple(before), writes))
+		self.ticks = self.memory.status_registers["ticks"]
+		self.step += 1
+		if self.step % self.interval == 0:
+			self.__snapshot()
+
+	def back(self, steps: int = 1):
+		self.goto(max(self.start, self.step - steps))
+
+	def goto(self, step: int):
+		if not self.start <= step <= self.end:
+			raise ValueError(f"Step {step} is outside the history ({self.start} to {self.end})")
+		memory = self.memory
+		if self.step == self.end:
+			self.final = (memory.registers[:], dict(memory.status_registers))
+		if abs(step - self.step) > self.interval:
+			first = self.snapshots[0].step
+			self.__restore(self.snapshots[min((step - first) // self.interval, len(self.snapshots) - 1)])
+		entries = self.entries
+		while self.step > step:
+			self.step -= 1
+			for kind, address, old, new in reversed(entries[self.step - self.start][3]):
+				self.__write(kind, address, old)
+		while self.step < step:
+			for kind, address, old, new in entries[self.step - self.start][3]:
+				self.__write(kind, address, new)
+			self.step += 1
+		if step == self.end:
+			registers, status_registers = self.final
+		else:
+			ip, ticks, registers, _ = entries[step - self.start]
+			status_registers = {"ip": ip, "halt": 0, "error": 0, "ticks": ticks, "cycles": self.cycles + step}
+		memory.registers[:] = registers
+		memory.status_registers.update(status_registers)
+		self.ticks = memory.status_registers["ticks"]
+
+	def __write(self, kind: int, address: int, value: int):
+		if kind == WRITE_MEMORY:
+			self.memory.set_val(address, value)
+		else:
+			self.memory.disk[address] = value
+
+	def __chunks(self, storage, previous: list[bytes]|None, dirty: set[int]) -> list[bytes]:
+		size = self.CHUNK
+		if previous is None:
+			return [bytes(storage[i: i + size]) for i in range(0, len(storage), size)]
+		chunks = previous[:]
+		for chunk in dirty:
+			chunks[chunk] = bytes(storage[chunk * size: (chunk + 1) * size])
+		return chunks
+
+	def __snapshot(self):
+		memory = self.memory
+		previous = self.snapshots[-1] if self.snapshots else None
+		self.snapshots.append(Snapshot(
+			self.step,
+			self.__chunks(memory.addresses, previous and previous.memory, self.dirty[WRITE_MEMORY]),
+			self.__chunks(memory.disk, previous and previous.disk, self.dirty[WRITE_DISK]),
+			self.dirty,
+		))
+		self.dirty = (set(), set())
+		if len(self.snapshots) > self.max_snapshots:
+			self.snapshots.popleft()
+			oldest = self.snapshots[0].step
+			del self.entries[:oldest - self.start]
+			self.start = oldest
+
+	def __restore(self, snapshot: Snapshot):
+		# Only chunks written between the current step and the snapshot differ
+		low, high = sorted((self.step, snapshot.step))
+		changed = (set(), set())
+		for other in self.snapshots:
+			if low < other.step < high + self.interval:
+				changed[WRITE_MEMORY].update(other.changed[WRITE_MEMORY])
+				changed[WRITE_DISK].update(other.changed[WRITE_DISK])
+		if high > self.snapshots[-1].step:
+			changed[WRITE_MEMORY].update(self.dirty[WRITE_MEMORY])
+			changed[WRITE_DISK].update(self.dirty[WRITE_DISK])
+		memory = self.memory
+		size = self.CHUNK
+		for chunk in changed[WRITE_MEMORY]:
+			memory.addresses[chunk * size: (chunk + 1) * size] = array(DISK_WORD.typecode, snapshot.memory[chunk])
+			code = memory.decoded[chunk * size: min((chunk + 1) * size, memory.program_size)]
+			memory.decoded[chunk * size: chunk * size + len(code)] = [None] * len(code)
+		for chunk in changed[WRITE_DISK]:
+			memory.disk[chunk * size: (chunk + 1) * size] = array(DISK_WORD.typecode, snapshot.disk[chunk])
+		self.step = snapshot.step
+
+	def __truncate(self):
+		# Running on from an earlier step forgets the steps after it
+		del self.entries[self.step - self.start:]
+		while self.snapshots[-1].step > self.step:
+			dropped = self.snapshots.pop()
+			self.dirty[WRITE_MEMORY].update(dropped.changed[WRITE_MEMORY])
+			self.dirty[WRITE_DISK].update(dropped.changed[WRITE_DISK])
+		self.final = None
+
+
+# Checkpoint file: the whole machine, so a run can be resumed or forked.
+# Header, the program as it was loaded and its symbols, the registers,
+# the status registers by name, memory as (start, words) segments
+# leaving out rows of zeros, the disk, and one byte per program address
+# that is 1 if it had been decoded. Words are raw arrays in native byte
+# order like disk files; registers aren't limited to 64 bits and are
+# stored as variable length integers.
+CHECKPOINT_MAGIC = b"ASMC"
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = Struct("<4sHIIBBIQ") # magic, version, program words, symbols, registers, status registers, segments, disk words
+CHECKPOINT_REGISTER = Struct("<H") # byte length
+CHECKPOINT_STATUS = Struct("<qH") # value, name length
+CHECKPOINT_SEGMENT = Struct("<QI") # first address, word count
+CHECKPOINT_ROW = 4096 # words per memory segment
+
+
+@dataclass
+class Checkpoint:
+	words: array # the program as loaded, for VM.reset
+	symbols: dict[str, int]
+	registers: list[int]
+	status_registers: dict[str, int]
+	segments: list[tuple[int, array]]
+	disk: array
+	decoded: array
+
+
+def is_checkpoint(path: Path) -> bool:
+	with open(path, "rb") as f:
+		return f.read(len(CHECKPOINT_MAGIC)) == CHECKPOINT_MAGIC
+
+
+def write_checkpoint(path: Path, checkpoint: Checkpoint):
+	# Written beside path and renamed over it, so a run stopped halfway
+	# through leaves the previous checkpoint intact
+	partial = path.with_name(path.name + ".partial")
+	with open(partial, "wb") as f:
+		f.write(CHECKPOINT_HEADER.pack(
+			CHECKPOINT_MAGIC,
+			CHECKPOINT_VERSION,
+			len(checkpoint.words),
+			len(checkpoint.symbols),
+			len(checkpoint.registers),
+			len(checkpoint.status_registers),
+			len(checkpoint.segments),
+			len(checkpoint.disk),
+		))
+		f.write(checkpoint.words.tobytes())
+		for name, address in checkpoint.symbols.items():
+			encoded = name.encode()
+			f.write(OBJECT_SYMBOL.pack(address, len(encoded)))
+			f.write(encoded)
+		for value in checkpoint.registers:
+			encoded = value.to_bytes(value.bit_length() // 8 + 1, "little", signed=True)
+			f.write(CHECKPOINT_REGISTER.pack(len(encoded)))
+			f.write(encoded)
+		for name, value in checkpoint.status_registers.items():
+			encoded = name.encode()
+			f.write(CHECKPOINT_STATUS.pack(value, len(encoded)))
+			f.write(encoded)
+		for start, words in checkpoint.segments:
+			f.write(CHECKPOINT_SEGMENT.pack(start, len(words)))
+			f.write(words.tobytes())
+		f.write(checkpoint.disk.tobytes())
+		f.write(checkpoint.decoded.tobytes())
+	replace(partial, path)
+
+
+def read_checkpoint(path: Path) -> Checkpoint:
+	with open(path, "rb") as f:
+		data = memoryview(f.read())
+	try:
+		magic, version, word_count, symbol_count, register_count, status_count, segment_count, disk_size = CHECKPOINT_HEADER.unpack_from(data)
+		if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+			raise ValueError(f"{path} is not a version {CHECKPOINT_VERSION} checkpoint")
+		offset = CHECKPOINT_HEADER.size
+
+		def words(count: int, typecode: str = DISK_WORD.typecode) -> array:
+			nonlocal offset
+			block = array(typecode)
+			if offset + count * block.itemsize > len(data):
+				raise ValueError(f"{path} is truncated")
+			block.frombytes(data[offset: offset + count * block.itemsize])
+			offset += count * block.itemsize
+			return block
+
+		def name(length: int) -> str:
+			nonlocal offset
+			offset += length
+			return str(data[offset - length: offset], "utf-8")
+
+		program = words(word_count)
+		symbols = {}
+		for _ in range(symbol_count):
+			address, length = OBJECT_SYMBOL.unpack_from(data, offset)
+			offset += OBJECT_SYMBOL.size
+			symbols[name(length)] = address
+		registers = []
+		for _ in range(register_count):
+			(length,) = CHECKPOINT_REGISTER.unpack_from(data, offset)
+			offset += CHECKPOINT_REGISTER.size + length
+			registers.append(int.from_bytes(data[offset - length: offset], "little", signed=True))
+		status_registers = {}
+		for _ in range(status_count):
+			value, length = CHECKPOINT_STATUS.unpack_from(data, offset)
+			offset += CHECKPOINT_STATUS.size
+			status_registers[name(length)] = value
+		segments = []
+		for _ in range(segment_count):
+			start, count = CHECKPOINT_SEGMENT.unpack_from(data, offset)
+			offset += CHECKPOINT_SEGMENT.size
+			segments.append((start, words(count)))
+		disk = words(disk_size)
+		decoded = words(word_count, "B")
+		return Checkpoint(program, symbols, registers, status_registers, segments, disk, decoded)
+	except StructError:
+		raise ValueError(f"{path} is truncated") from None
+
+
+ENGINES = ("interpret", "compile", "threaded")
 
+
+@dataclass
+class Limits:
+	max_steps: int|None = None
+	timeout: float|None = None # seconds of wall time
+
+
+@dataclass
+class Result:
+	status: str # halted, error, crash, step_limit or time_limit
+	exit_code: int
+	stdout: str|None
+	steps: int
+	wall_time: float
+	registers: dict[str, int]
+	error: str|None = None
+	virtual_time: float = 0.0 # seconds of SKIP on the virtual clock
+	cycles: int = 0 # instructions executed since the program was loaded, across runs
+
+
+class VM:
+	# A reusable machine for library use. Load a program once, then reset
+	# and run it as many times as needed from the same process. Output
+	# that isn't captured goes to output, anything with write(), or stdout.
+	SLICE = 10_000 # Instructions run between limit checks
+
+	def __init__(self, mmu: FlatMMU|PagedMMU|None = None, disk_size: int = 100, disk_file: Path|None = None, engine: str = "interpret", profile: bool = False, trace: Path|None = None, trace_ring: int|None = None, history_interval: int|None = None, history_snapshots: int = 16, clock: str = "real", output = None, optimize: bool = False, checkpoint: Path|None = None, checkpoint_interval: int = 1_000_000):
+		if engine not in ENGINES:
+			raise ValueError(f"Unknown engine {engine}")
+		if clock not in CLOCKS:
+			raise ValueError(f"Unknown clock {clock}")
+		if clock == "async" and engine == "compile":
+			raise ValueError("The async clock is only supported by the interpret and threaded engines")
+		if checkpoint is not None and engine == "compile":
+			raise ValueError("Checkpoints are only supported by the interpret and threaded engines")
+		recording = [option for option, enabled in (("profiling", profile), ("tracing", trace is not None), ("history", history_interval is not None), ("optimization", optimize)) if enabled]
+		if recording and engine != "interpret":
+			raise ValueError(f"{recording[0].capitalize()} is only supported by the interpret engine")
+		if len(recording) > 1:
+			raise ValueError(f"{' and '.join(recording).capitalize()} can't be combined")
+		self.profile = profile
+		self.profiler = None
+		self.trace = trace
+		self.trace_ring = trace_ring
+		self.tracer = None
+		self.history_interval = history_interval
+		self.history_snapshots = history_snapshots
+		self.history = None
+		self.optimize = optimize
+		self.optimizer = None
+		self.checkpoint = checkpoint
+		self.checkpoint_interval = checkpoint_interval
+		self.journal = [] if trace is not None or history_interval is not None else None
+		self.output = output
+		self.memory = Memory(mmu=mmu or FlatMMU(), disk_size=disk_size, disk_file=disk_file, clock=clock, output=Output(output))
+		self.executor = Executor(self.memory, self.journal)
+		self.engine = engine
+		self.program = None
+		self.checked = False # whether the loaded program passed the ControlFlowGraph's checks
+		self.start_cycles = 0
+
+	def assemble(self, program_text: str):
+		offsets = array("Q")
+		words, symbols = Assembler(self.memory).assemble(read_lines(StringIO(program_text), offsets))
+		self.load(words, symbols, SourceMap(program_text, offsets))
+
+	def load_file(self, filename: Path):
+		if is_checkpoint(filename):
+			self.restore(filename)
+		else:
+			self.load(*read_program(self.memory, filename))
+
+	def load(self, words: list[int]|array, symbols: dict[str, int], source: SourceMap|None = None):
+		# source is only used to quote lines in error messages. Errors the
+		# ControlFlowGraph finds are reported by the first run, before the
+		# first step rather than partway through.
+		self.program = (words, symbols)
+		self.source = source
+		self.checked = False
+		self.reset()
+
+	def reset(self, inputs: Iterable[int]|dict[int, int]|None = None):
+		# Reload the program into a clean machine. inputs are the initial
+		# disk contents, either words from address 0 or an address mapping.
+		if self.program is None:
+			raise ValueError("No program loaded")
+		self.memory.close()
+		self.memory.load(*self.program)
+		self.memory.source = self.source
+		if inputs is not None:
+			items = inputs.items() if isinstance(inputs, dict) else enumerate(inputs)
+			for address, value in items:
+				self.memory.disk[address] = value
+		self.__start()
+
+	def save(self, path: Path):
+		# Checkpoint the machine, see Checkpoint. Output so far is flushed
+		# so it isn't repeated or lost when the checkpoint is resumed.
+		if self.program is None:
+			raise ValueError("No program loaded")
+		self.memory.output.flush()
+		write_checkpoint(path, self.memory.checkpoint(*self.program))
+
+	def restore(self, path: Path):
+		# Replaces the program and the machine's state with a checkpoint's,
+		# including which instructions were decoded. reset afterwards starts
+		# the checkpoint's program over.
+		checkpoint = read_checkpoint(path)
+		self.program = (checkpoint.words, checkpoint.symbols)
+		self.source = None
+		self.memory.close()
+		self.memory.load(*self.program)
+		self.memory.restore(checkpoint)
+		self.checked = True # when its program was loaded
+		self.__start()
+		self.memory.predecode(self.executor, [address for address, decoded in enumerate(checkpoint.decoded) if decoded])
+
+	def __start(self):
+		# The optimizer and recorders start from the machine as it is
+		self.compiled = None # False once a STORE has made it out of date
+		self.threaded = None
+		self.graph = None
+		if self.optimize:
+			self.optimizer = Optimizer(self.memory, self.__graph())
+			self.optimizer.optimize()
+		if self.profile:
+			self.profiler = Profiler(self.memory, self.__graph())
+		if self.trace is not None:
+			if self.tracer is not None:
+				self.tracer.close()
+			self.tracer = Tracer(self.trace, self.journal, self.trace_ring)
+		if self.history_interval is not None:
+			self.history = History(self.memory, self.journal, self.history_interval, self.history_snapshots)
+
+	def __graph(self) -> ControlFlowGraph:
+		# Of the code as __start found it, built the first time something
+		# needs it and then shared
+		if self.graph is None:
+			memory = self.memory
+			self.graph = ControlFlowGraph(memory.get_val(address) for address in range(memory.program_size))
+		return self.graph
+
+	def run(self, limits: Limits|None = None, capture: bool = True) -> Result:
+		# Runs from the current state. Program errors are reported in the
+		# Result rather than raised. With the async clock SKIP sleeps here.
+		limits = limits or Limits()
+		out = self.__capture(capture)
+		self.start_cycles = self.memory.status_registers["cycles"]
+		start = monotonic()
+		try:
+			for delay in self.__run(limits, start):
+				if delay:
+					self.memory.output.flush()
+				sleep(delay)
+		except Exception as e:
+			return self.__result(out, start, e)
+		return self.__result(out, start)
+
+	async def run_async(self, limits: Limits|None = None, capture: bool = True, quantum: int|None = None) -> Result:
+		# Same as run, but with the async clock SKIP awaits on the event loop
+		# instead of blocking it, so many machines can share one thread.
+		# With quantum other tasks also get to run every quantum steps.
+		limits = limits or Limits()
+		out = self.__capture(capture)
+		self.start_cycles = self.memory.status_registers["cycles"]
+		start = monotonic()
+		try:
+			for delay in self.__run(limits, start, quantum):
+				if delay:
+					self.memory.output.flush()
+				await asyncio.sleep(delay)
+		except Exception as e:
+			return self.__result(out, start, e)
+		return self.__result(out, start)
+
+	@property
+	def steps(self) -> int:
+		# Instructions executed by the current or last run
+		return self.memory.status_registers["cycles"] - self.start_cycles
+
+	def __capture(self, capture: bool) -> StringIO|None:
+		# Captured output goes to a StringIO instead of the VM's output
+		out = StringIO() if capture else None
+		self.memory.output.sink = out or self.output
+		return out
+
+	def __result(self, out: StringIO|None, start: float, e: Exception|None = None) -> Result:
+		self.memory.output.flush()
+		self.memory.output.sink = self.output
+		status = self.status
+		exit_code = EXT_SUCCESS
+		error = None
+		if isinstance(e, AsmError):
+			if out is not None:
+				out.write(f"{e}\n")
+			status = "error"
+			exit_code = 1
+			error = str(e)
+		elif e is not None:
+			status = "crash"
+			exit_code = 1
+			error = f"{type(e).__name__}: {e}"
+			# Reported like a program error, at the instruction that crashed
+			memory = self.memory
+			ip = memory.status_registers["ip"]
+			error = str(AsmError(error, ip, None if memory.source is None else memory.source.line(ip)))
+		if status in ("step_limit", "time_limit"):
+			exit_code = EXT_ERR_LIMIT
+		return Result(
+			status,
+			exit_code,
+			out.getvalue() if out is not None else None,
+			self.steps,
+			monotonic() - start,
+			dict(zip(REGISTERS, self.memory.registers)),
+			error,
+			self.memory.status_registers["ticks"] / TICKS_PER_SECOND,
+			self.memory.status_registers["cycles"],
+		)
+
+	def __run(self, limits: Limits, start: float, quantum: int|None = None) -> Iterator[float]:
+		# Yields the seconds to wait whenever the machine is suspended, and
+		# after every quantum steps, and leaves how the run ended in status.
+		# With a checkpoint file the machine is saved every
+		# checkpoint_interval steps and when a limit stops it. Limits are
+		# checked between slices of at most SLICE steps, never per step.
+		memory = self.memory
+		status_registers = memory.status_registers
+		recorder = self.tracer or self.history
+		self.status = "halted"
+		if not self.checked:
+			graph = self.__graph()
+			if graph.errors:
+				address, message = graph.errors[0]
+				raise AsmError(message, address, None if self.source is None else self.source.line(address))
+			self.checked = True
+		if self.engine == "threaded":
+			if self.threaded is None:
+				self.threaded = ThreadedCode(memory)
+			fde_cycle = self.threaded.fde_cycle
+		else:
+			fde_cycle = partial(memory.fde_cycle, self.executor, profiler=self.profiler, recorder=recorder)
+		if self.engine == "compile":
+			if self.compiled is None:
+				self.compiled = Compiler(memory, self.__graph()).compile()
+			fde_cycle = partial(self.__compiled_cycle, fde_cycle)
+		self.graph = None # only needed before the first step
+		ran = 0 # steps in the last slice, and when it started
+		sliced = start
+		while not status_registers["halt"]:
+			ticks = status_registers["ticks"]
+			if self.checkpoint is not None and self.steps and self.steps % self.checkpoint_interval == 0:
+				self.save(self.checkpoint)
+			if limits.max_steps is None and limits.timeout is None and quantum is None and self.checkpoint is None:
+				fde_cycle()
+			else:
+				slice_ = quantum or self.SLICE
+				if self.checkpoint is not None:
+					slice_ = min(slice_, self.checkpoint_interval - self.steps % self.checkpoint_interval)
+				if limits.max_steps is not None:
+					if self.steps >= limits.max_steps:
+						self.status = "step_limit"
+						break
+					slice_ = min(slice_, limits.max_steps - self.steps)
+				if limits.timeout is not None:
+					now = monotonic()
+					if now - start >= limits.timeout:
+						self.status = "time_limit"
+						break
+					# Sized by the speed of the last slice to end near the
+					# deadline, and at most twice as long, so instructions that
+					# take a while, like SKIP on the real clock, can't carry the
+					# run far past it
+					speed = ran / max(now - sliced, 1e-6)
+					slice_ = max(1, min(slice_, 2 * ran, int(speed * (limits.timeout - (now - start)))))
+					sliced = now
+				ran = fde_cycle(slice_)
+			if status_registers["halt"] == SUSPENDED:
+				# Wait out the virtual time SKIP added, if any
+				status_registers["halt"] = 0
+				yield (status_registers["ticks"] - ticks) / TICKS_PER_SECOND
+			elif quantum is not None and not status_registers["halt"]:
+				yield 0
+		if self.status != "halted" and self.checkpoint is not None:
+			self.save(self.checkpoint)
+
+	def __compiled_cycle(self, interpret: Callable, max_steps: int|None = None) -> int:
+		# Same as Memory.fde_cycle. Compiled code runs whole basic blocks
+		# while they fit in max_steps; where it can't go on, at the end of
+		# max_steps or with ip inside a block, the interpreter takes single
+		# steps until it can. Once a STORE has overwritten code the compiled
+		# program is out of date and only the interpreter runs.
+		status_registers = self.memory.status_registers
+		cycles = status_registers["cycles"]
+		ran = 0
+		while not status_registers["halt"] and ran != max_steps:
+			left = None if max_steps is None else max_steps - ran
+			if self.compiled and not self.compiled(left):
+				self.compiled = False
+			if status_registers["cycles"] - cycles == ran and not status_registers["halt"]:
+				interpret(left if not self.compiled else 1)
+			ran = status_registers["cycles"] - cycles
+		return ran
+
+	def close(self):
+		self.memory.close()
+		if self.tracer is not None:
+			self.tracer.close()
+			self.tracer = None
+
+
+def run(program_text: str, *, inputs: Iterable[int]|dict[int, int]|None = None, limits: Limits|None = None, **options) -> Result:
+	# Assemble and run a program in a fresh VM. options are passed to VM.
+	vm = VM(**options)
+	try:
+		vm.assemble(program_text)
+	except AsmError as e:
+		return Result("error", 1, f"{e}\n", 0, 0.0, dict(zip(REGISTERS, vm.memory.registers)), str(e))
+	vm.reset(inputs)
+	try:
+		return vm.run(limits)
+	finally:
+		vm.close()
+
+
+class Scheduler:
+	# Runs many machines cooperatively on one event loop. A machine runs
+	# for at most quantum steps, or until the async clock suspends it on
+	# SKIP or I/O, before the others get a turn, and the event loop serves
+	# them round robin. limits apply to every machine unless run is given
+	# its own, and at most concurrency machines run at once.
+	def __init__(self, quantum: int = 1000, limits: Limits|None = None, concurrency: int|None = None):
+		self.quantum = quantum
+		self.limits = limits or Limits()
+		self.slots = None if concurrency is None else asyncio.Semaphore(concurrency)
+
+	async def run(self, vm: VM, limits: Limits|None = None, capture: bool = True) -> Result:
+		async with self.slots or nullcontext():
+			return await vm.run_async(limits or self.limits, capture, self.quantum)
+
+	async def run_all(self, vms: Iterable[VM]) -> list[Result]:
+		return await asyncio.gather(*(self.run(vm) for vm in vms))
+
+
+class ArgumentParser(argparse.ArgumentParser):
+	def error(self, message: str):
+		self.print_usage()
+		print(f"{self.prog}: error: {message}")
+		exit(EXT_ERR_BAD_ARGUMENTS)
+
+
+def positive_int(text: str) -> int:
+	# argparse type for limits, where 0 would stop before the first step
+	value = int(text)
+	if value <= 0:
+		raise argparse.ArgumentTypeError(f"{text} is not a positive number")
+	return value
+
+
+def positive_float(text: str) -> float:
+	value = float(text)
+	if not value > 0:
+		raise argparse.ArgumentTypeError(f"{text} is not a positive number")
+	return value
+
+
+def read_program(memory: Memory, filename: Path) -> tuple[list[int]|array, dict[str, int], SourceMap|None]:
+	# Object files are mapped as they are, anything else is assembled
+	# while it is read
+	if is_object_file(filename):
+		return *read_object(filename), None
+	offsets = array("Q")
+	with open(filename, "rb") as f:
+		words, symbols = Assembler(memory).assemble(read_lines(f, offsets))
+	return words, symbols, SourceMap(filename, offsets)
+
+
+def check(words: list[int]|array, source: SourceMap|None):
+	# Prints what the ControlFlowGraph finds and exits
+	graph = ControlFlowGraph(words)
+	for address, message in graph.errors:
+		print(AsmError(message, address, None if source is None else source.line(address)))
+	for address, message in graph.warnings:
+		print(f"Warning: {AsmError(message, address, None if source is None else source.line(address))}")
+	print(f"{len(graph.blocks)} blocks, {len(graph.reachable)} reachable, {len(graph.loops)} loops")
+	exit(1 if graph.errors else EXT_SUCCESS)
+
+
+def main():
+	arg_parser = ArgumentParser(prog="asm.py")
+	arg_parser.add_argument("filename", type=Path, help="source or object file to run")
+	arg_parser.add_argument("--engine", choices=ENGINES, default="interpret")
+	arg_parser.add_argument("-o", "--output", type=Path, help="assemble into this object file instead of running")
+	arg_parser.add_argument("--memory-size", type=int, default=100, help="words of main memory")
+	arg_parser.add_argument("--mmu", choices=("flat", "paged"), default="flat", help="flat memory, or a sparse paged 32 bit address space")
+	arg_parser.add_argument("--page-bits", type=int, default=12, help="log2 of the page size in words")
+	arg_parser.add_argument("--tlb-size", type=int, default=16, help="TLB entries")
+	arg_parser.add_argument("--mmu-stats", action="store_true", help="print page fault and TLB counters at exit")
+	arg_parser.add_argument("--disk-size", type=int, default=100, help="words of disk")
+	arg_parser.add_argument("--disk-file", type=Path, help="memory map the disk onto this file")
+	arg_parser.add_argument("--profile", action="store_true", help="print a hot spot report at exit")
+	arg_parser.add_argument("--profile-out", type=Path, help="write the profile to this JSON file")
+	arg_parser.add_argument("--trace", type=Path, help="record every step to this binary trace file")
+	arg_parser.add_argument("--trace-ring", type=int, help="only keep the last N steps of the trace")
+	arg_parser.add_argument("--clock", choices=("real", "simulated"), default="real", help="simulated makes SKIP advance a virtual clock instead of sleeping")
+	arg_parser.add_argument("--print-to", type=Path, help="write the program's output to this file")
+	arg_parser.add_argument("--optimize", action="store_true", help="fuse and fold instructions before running, and report how many were eliminated")
+	arg_parser.add_argument("--check", action="store_true", help="report problems found without running, unreachable code included, then exit")
+	arg_parser.add_argument("--checkpoint", type=Path, help="save the machine to this file every --checkpoint-every steps, run the file to resume")
+	arg_parser.add_argument("--checkpoint-every", type=int, default=1_000_000, help="steps between checkpoints")
+	arg_parser.add_argument("--max-steps", type=positive_int, help=f"stop after this many instructions with exit status {EXT_ERR_LIMIT}")
+	arg_parser.add_argument("--timeout", type=positive_float, help=f"stop after this many seconds of wall time with exit status {EXT_ERR_LIMIT}")
+	args = arg_parser.parse_args()
+
+	filename = args.filename
+
+	if not filename.is_file():
+		print(f"{filename} is not a file")
+		exit(EXT_ERR_NOT_A_FILE)
+
+	if args.mmu == "paged":
+		mmu = PagedMMU(args.page_bits, args.tlb_size)
+	else:
+		mmu = FlatMMU(args.memory_size)
+
+	profile = args.profile or args.profile_out is not None
+	recording = [option for option, enabled in (("--profile", profile), ("--trace", args.trace is not None), ("--optimize", args.optimize)) if enabled]
+	if recording and args.engine != "interpret":
+		arg_parser.error(f"{recording[0]} needs --engine=interpret")
+	if len(recording) > 1:
+		arg_parser.error(f"{' and '.join(recording)} can't be combined")
+	if args.checkpoint is not None and args.engine == "compile":
+		arg_parser.error("--checkpoint needs --engine=interpret or --engine=threaded")
+	output = None if args.print_to is None else open(args.print_to, "w")
+	vm = VM(mmu, args.disk_size, args.disk_file, args.engine, profile, args.trace, args.trace_ring, clock=args.clock, output=output, optimize=args.optimize, checkpoint=args.checkpoint, checkpoint_interval=args.checkpoint_every)
+	if is_checkpoint(filename):
+		vm.restore(filename)
+	else:
+		try:
+			words, symbols, source = read_program(vm.memory, filename)
+			if args.check:
+				check(words, source)
+			vm.load(words, symbols, source)
+		except AsmError as e:
+			print(e)
+			exit(1)
+
+		if args.output is not None:
+			write_object(args.output, words, symbols)
+			exit(EXT_SUCCESS)
+	result = vm.run(Limits(args.max_steps, args.timeout), capture=False)
+	vm.close()
+	if output is not None:
+		output.close()
+	if result.error is not None:
+		print(result.error)
+	match result.status:
+		case "step_limit":
+			print(f"Step limit reached after {result.steps} steps")
+		case "time_limit":
+			print(f"Time limit reached after {result.wall_time:.2f}s ({result.steps} steps)")
+
+	if args.mmu_stats:
+		for name, value in vm.memory.mmu.stats().items():
+			print(f"{name}: {value}")
+	if args.optimize:
+		stats = vm.optimizer.stats
+		print(f"Optimizer: {sum(stats.values())} instructions eliminated ({stats['fused']} fused, {stats['dead']} dead)")
+	if args.profile:
+		print(vm.profiler.report())
+	if args.profile_out is not None:
+		with open(args.profile_out, "w") as f:
+			json.dump(vm.profiler.to_dict(), f, indent=2)
+	exit(result.exit_code)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,111 @@
+import argparse
+from pathlib import Path
+
+from asm import VM, FlatMMU, Limits, AsmError, REGISTERS, decode_instruction, disassemble
+
+"""
+Interactive debugger that can step backwards as well as forwards.
+
+Usage: asmdebug.py FILE [--interval N] [--snapshots N] [--memory-size N] [--disk-size N]
+
+Commands:
+	s [N]        step N instructions (default 1)
+	b [N]        step N instructions back (default 1)
+	g STEP       go to a step, forwards or backwards
+	c            continue until HALT
+	r            registers
+	m ADDR [N]   N words of memory from ADDR
+	d ADDR [N]   N words of disk from ADDR
+	q            quit
+"""
+
+
+def where(vm: VM) -> str:
+	memory = vm.memory
+	ip = memory.status_registers["ip"]
+	if memory.status_registers["halt"]:
+		instruction = "halted"
+	elif 0 <= ip - memory.starting_address < memory.program_size:
+		labels = {address: name for name, address in memory.label_table.items()}
+		instruction = disassemble(decode_instruction(memory.fetch()), ip, labels)
+	else:
+		instruction = "end of program"
+	return f"step {vm.history.step}, ip {ip}: {instruction}"
+
+
+def forward(vm: VM, steps: int|None):
+	# Steps already recorded are replayed, the rest are run
+	history = vm.history
+	if steps is not None and history.step + steps <= history.end:
+		history.goto(history.step + steps)
+		return
+	if steps is not None:
+		steps -= history.end - history.step
+	history.goto(history.end)
+	result = vm.run(Limits(max_steps=steps), capture=False)
+	if result.error is not None:
+		print(result.error)
+
+
+def main():
+	arg_parser = argparse.ArgumentParser(prog="asmdebug.py")
+	arg_parser.add_argument("filename", type=Path, help="source or object file to debug")
+	arg_parser.add_argument("--interval", type=int, default=1000, help="steps between snapshots")
+	arg_parser.add_argument("--snapshots", type=int, default=16, help="snapshots kept, older steps are forgotten")
+	arg_parser.add_argument("--memory-size", type=int, default=100, help="words of main memory")
+	arg_parser.add_argument("--disk-size", type=int, default=100, help="words of disk")
+	args = arg_parser.parse_args()
+
+	vm = VM(FlatMMU(args.memory_size), args.disk_size, history_interval=args.interval, history_snapshots=args.snapshots)
+	try:
+		vm.load_file(args.filename)
+	except AsmError as e:
+		print(e)
+		exit(1)
+
+	print(where(vm))
+	while True:
+		try:
+			command, *operands = input("(asm) ").split() or [""]
+		except EOFError:
+			break
+		try:
+			operands = [int(operand) for operand in operands]
+			match command:
+				case "s":
+					forward(vm, operands[0] if operands else 1)
+				case "b":
+					vm.history.back(operands[0] if operands else 1)
+				case "g":
+					if operands[0] > vm.history.step:
+						forward(vm, operands[0] - vm.history.step)
+					else:
+						vm.history.goto(operands[0])
+				case "c":
+					forward(vm, None)
+				case "r":
+					print(", ".join(f"{name}={value}" for name, value in zip(REGISTERS, vm.memory.registers)))
+					continue
+				case "m" | "d":
+					start, count = operands[0], operands[1] if len(operands) > 1 else 1
+					if command == "m":
+						print([vm.memory.get_val(address) for address in range(start, start + count)])
+					else:
+						print(vm.memory.disk[start: start + count].tolist())
+					continue
+				case "q":
+					break
+				case "":
+					continue
+				case _:
+					print(f"Unknown command {command}")
+					continue
+		except (ValueError, IndexError) as e:
+			print(e)
+			continue
+		print(where(vm))
+	vm.close()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,132 @@
+import argparse
+from pathlib import Path
+
+from asm import read_trace, Opcode, REGISTERS, REGISTER_NUMBERS, WRITE_MEMORY
+
+"""
+Offline inspector for traces recorded with asm.py --trace.
+
+Usage:
+	asmtrace.py summary TRACE
+	asmtrace.py show TRACE [--from STEP] [--to STEP] [--ip IP] [--opcode NAME] [--register R] [--address ADDR]
+	asmtrace.py replay TRACE STEP
+"""
+
+
+def summary(path: Path):
+	steps = 0
+	first = None
+	opcodes = {}
+	ips = {}
+	register_writes = {}
+	memory_writes = 0
+	disk_writes = 0
+	for step in read_trace(path):
+		if first is None:
+			first = step.step
+		steps += 1
+		opcodes[step.opcode.name] = opcodes.get(step.opcode.name, 0) + 1
+		ips[step.ip] = ips.get(step.ip, 0) + 1
+		for slot, _ in step.registers:
+			register_writes[REGISTERS[slot]] = register_writes.get(REGISTERS[slot], 0) + 1
+		for kind, _, _ in step.writes:
+			if kind == WRITE_MEMORY:
+				memory_writes += 1
+			else:
+				disk_writes += 1
+	if not steps:
+		print("Empty trace")
+		return
+	print(f"Steps {first} to {first + steps - 1} ({steps} recorded)")
+	print(f"Memory writes: {memory_writes}, disk writes: {disk_writes}")
+	print("Opcodes:")
+	for name, count in sorted(opcodes.items(), key=lambda item: item[1], reverse=True):
+		print(f"  {count:>10}  {name}")
+	print("Hottest addresses:")
+	for ip, count in sorted(ips.items(), key=lambda item: item[1], reverse=True)[:10]:
+		print(f"  {count:>10}  {ip}")
+	print("Register changes:")
+	for register, count in sorted(register_writes.items()):
+		print(f"  {count:>10}  {register}")
+
+
+def format_step(step) -> str:
+	changes = [f"{REGISTERS[slot]}={value}" for slot, value in step.registers]
+	changes += [f"{'M' if kind == WRITE_MEMORY else 'D'}[{address}]={value}" for kind, address, value in step.writes]
+	return f"{step.step:>10}  {step.ip:>6}  {step.opcode.name:<6} {' '.join(changes)}"
+
+
+def show(path: Path, args):
+	register = None if args.register is None else REGISTER_NUMBERS[args.register]
+	opcode = None if args.opcode is None else Opcode[args.opcode.upper()]
+	for step in read_trace(path):
+		if args.start is not None and step.step < args.start:
+			continue
+		if args.end is not None and step.step > args.end:
+			break
+		if args.ip is not None and step.ip != args.ip:
+			continue
+		if opcode is not None and step.opcode != opcode:
+			continue
+		if register is not None and all(slot != register for slot, _ in step.registers):
+			continue
+		if args.address is not None and all(address != args.address for _, address, _ in step.writes):
+			continue
+		print(format_step(step))
+
+
+def replay(path: Path, target: int):
+	# Rebuild registers and every written location as they were after
+	# target. Locations never written in the trace are not known.
+	registers = [None] * len(REGISTERS)
+	memory = {}
+	disk = {}
+	last = None
+	for step in read_trace(path):
+		if step.step == 0: # A full trace, registers start cleared
+			registers = [0] * len(REGISTERS)
+		if step.step > target:
+			break
+		for slot, value in step.registers:
+			registers[slot] = value
+		for kind, address, value in step.writes:
+			(memory if kind == WRITE_MEMORY else disk)[address] = value
+		last = step
+	if last is None:
+		print(f"Step {target} is not in the trace")
+		return
+	print(f"After step {last.step} (ip {last.ip}, {last.opcode.name}):")
+	print("Registers: " + ", ".join(f"{name}={'?' if value is None else value}" for name, value in zip(REGISTERS, registers)))
+	print(f"Memory: {dict(sorted(memory.items()))}")
+	print(f"Disk: {dict(sorted(disk.items()))}")
+
+
+def main():
+	arg_parser = argparse.ArgumentParser(prog="asmtrace.py")
+	commands = arg_parser.add_subparsers(dest="command", required=True)
+	command = commands.add_parser("summary", help="opcode, address and write counts")
+	command.add_argument("trace", type=Path)
+	command = commands.add_parser("show", help="print steps, optionally filtered")
+	command.add_argument("trace", type=Path)
+	command.add_argument("--from", dest="start", type=int)
+	command.add_argument("--to", dest="end", type=int)
+	command.add_argument("--ip", type=int)
+	command.add_argument("--opcode")
+	command.add_argument("--register", choices=REGISTERS, help="steps that changed this register")
+	command.add_argument("--address", type=int, help="steps that wrote this memory or disk address")
+	command = commands.add_parser("replay", help="registers and written memory after a step")
+	command.add_argument("trace", type=Path)
+	command.add_argument("step", type=int)
+	args = arg_parser.parse_args()
+
+	match args.command:
+		case "summary":
+			summary(args.trace)
+		case "show":
+			show(args.trace, args)
+		case "replay":
+			replay(args.trace, args.step)
+
+
+if __name__ == "__main__":
+	main()
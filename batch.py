@@ -0,0 +1,105 @@
+import argparse
+import json
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from functools import partial
+from os import cpu_count
+from pathlib import Path
+
+from asm import VM, FlatMMU, Limits, Result, AsmError, Scheduler, positive_int, positive_float
+
+"""
+Runs many programs in parallel, one isolated Memory per program, and
+writes one JSON line per program to the results file. With --async the
+programs share this process instead, interleaved by a Scheduler.
+
+Usage: batch.py DIRECTORY|MANIFEST [--jobs N | --async [--quantum N]] [--max-steps N] [--timeout SECONDS]
+"""
+
+
+def run_program(path: Path, limits: Limits, memory_size: int = 100, disk_size: int = 100, clock: str = "simulated") -> dict:
+	vm = VM(FlatMMU(memory_size), disk_size, clock=clock)
+	try:
+		vm.load_file(path)
+	except (AsmError, OSError, ValueError) as e:
+		return load_error(path, e)
+	else:
+		return {"path": str(path), **asdict(vm.run(limits))}
+	finally:
+		vm.close()
+
+
+async def run_program_async(path: Path, scheduler: Scheduler, memory_size: int = 100, disk_size: int = 100, clock: str = "simulated") -> dict:
+	vm = VM(FlatMMU(memory_size), disk_size, clock=clock)
+	try:
+		vm.load_file(path)
+	except (AsmError, OSError, ValueError) as e:
+		return load_error(path, e)
+	else:
+		return {"path": str(path), **asdict(await scheduler.run(vm))}
+	finally:
+		vm.close()
+
+
+def load_error(path: Path, e: Exception) -> dict:
+	# A program that couldn't be read or assembled, or a file that isn't one
+	error = str(e) if isinstance(e, AsmError) else f"{type(e).__name__}: {e}"
+	return {"path": str(path), **asdict(Result("error", 1, f"{error}\n", 0, 0.0, {}, error))}
+
+
+def collect(source: Path) -> list[Path]:
+	# A directory is searched for .asm files, anything else is a manifest
+	# listing one program per line relative to the manifest
+	if source.is_dir():
+		return sorted(source.rglob("*.asm"))
+	with open(source, "r") as f:
+		return [source.parent / line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def run_batch(paths: list[Path], limits: Limits, jobs: int|None = None, memory_size: int = 100, disk_size: int = 100, clock: str = "simulated"):
+	worker = partial(run_program, limits=limits, memory_size=memory_size, disk_size=disk_size, clock=clock)
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		chunksize = max(1, len(paths) // ((jobs or cpu_count() or 1) * 4))
+		yield from pool.map(worker, paths, chunksize=chunksize)
+
+
+def run_concurrent(paths: list[Path], limits: Limits, quantum: int = 1000, memory_size: int = 100, disk_size: int = 100, clock: str = "simulated") -> list[dict]:
+	# Real time SKIPs wait on the event loop rather than blocking it
+	scheduler = Scheduler(quantum, limits)
+	clock = "async" if clock == "real" else clock
+	async def run_all():
+		return await asyncio.gather(*(run_program_async(path, scheduler, memory_size, disk_size, clock) for path in paths))
+	return asyncio.run(run_all())
+
+
+def main():
+	arg_parser = argparse.ArgumentParser(prog="batch.py")
+	arg_parser.add_argument("source", type=Path, help="directory of .asm files or a manifest")
+	arg_parser.add_argument("-j", "--jobs", type=int, help="worker processes, defaults to one per core")
+	arg_parser.add_argument("--async", dest="concurrent", action="store_true", help="run every program in this process, interleaved")
+	arg_parser.add_argument("--quantum", type=int, default=1000, help="steps a program runs before the next gets a turn, with --async")
+	arg_parser.add_argument("--max-steps", type=positive_int, help="instructions per program")
+	arg_parser.add_argument("--timeout", type=positive_float, help="wall time per program in seconds")
+	arg_parser.add_argument("--memory-size", type=int, default=100, help="words of main memory")
+	arg_parser.add_argument("--disk-size", type=int, default=100, help="words of disk")
+	arg_parser.add_argument("--clock", choices=("real", "simulated"), default="simulated", help="real makes SKIP sleep")
+	arg_parser.add_argument("-o", "--output", type=Path, default=Path("results.jsonl"))
+	args = arg_parser.parse_args()
+
+	limits = Limits(args.max_steps, args.timeout)
+	paths = collect(args.source)
+	counts = {}
+	if args.concurrent:
+		results = run_concurrent(paths, limits, args.quantum, args.memory_size, args.disk_size, args.clock)
+	else:
+		results = run_batch(paths, limits, args.jobs, args.memory_size, args.disk_size, args.clock)
+	with open(args.output, "w") as f:
+		for result in results:
+			f.write(json.dumps(result) + "\n")
+			counts[result["status"]] = counts.get(result["status"], 0) + 1
+	print(f"{len(paths)} programs: " + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,118 @@
+import argparse
+import json
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+from asm import VM, FlatMMU, Compiler, ThreadedCode, ENGINES
+
+"""
+Benchmarks the engines on the workloads in bench/ and compares them with a
+stored baseline.
+
+For every workload and engine it reports instructions per second of
+execution, the time spent assembling, decoding (compiling, translating) and
+executing, and the peak Python memory allocated while running. A workload
+whose throughput falls more than --tolerance below the baseline counts as
+a regression and makes the run exit with status 1.
+
+Baselines depend on the machine, record one with --save before comparing.
+
+Usage: bench.py [--engine ENGINE] [--repeat N] [--save] [--tolerance FRACTION]
+"""
+
+BENCH_DIR = Path(__file__).parent / "bench"
+BASELINE = BENCH_DIR / "baseline.json"
+MEMORY_SIZE = 10_000
+DISK_SIZE = 10_000
+
+
+def measure(path: Path, engine: str, repeat: int) -> dict:
+	text = path.read_text()
+	vm = VM(FlatMMU(MEMORY_SIZE), DISK_SIZE, engine=engine)
+	best = None
+	for _ in range(repeat):
+		start = perf_counter()
+		vm.assemble(text)
+		assembled = perf_counter()
+		match engine:
+			case "compile":
+				vm.compiled = Compiler(vm.memory).compile()
+			case "threaded":
+				vm.threaded = ThreadedCode(vm.memory)
+			case _:
+				vm.memory.predecode(vm.executor)
+		decoded = perf_counter()
+		result = vm.run()
+		executed = perf_counter()
+		if result.status != "halted":
+			raise RuntimeError(f"{path.name} ({engine}): {result.error}")
+		timing = {
+			"assemble": assembled - start,
+			"decode": decoded - assembled,
+			"execute": executed - decoded,
+		}
+		if best is None or timing["execute"] < best["execute"]:
+			best = timing
+			steps = result.steps
+
+	# Memory is measured on a separate run since tracing slows execution
+	vm.reset()
+	tracemalloc.start()
+	vm.run()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	vm.close()
+	return {**best, "steps": steps, "peak_kib": peak / 1024}
+
+
+def main():
+	arg_parser = argparse.ArgumentParser(prog="bench.py")
+	arg_parser.add_argument("--engine", choices=ENGINES + ("all",), default="all")
+	arg_parser.add_argument("--repeat", type=int, default=3, help="runs per workload, the fastest is kept")
+	arg_parser.add_argument("--baseline", type=Path, default=BASELINE)
+	arg_parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+	arg_parser.add_argument("--tolerance", type=float, default=0.25, help="allowed throughput drop before failing")
+	arg_parser.add_argument("workloads", nargs="*", type=Path, help="defaults to bench/*.asm")
+	args = arg_parser.parse_args()
+
+	engines = ENGINES if args.engine == "all" else (args.engine,)
+	workloads = args.workloads or sorted(BENCH_DIR.glob("*.asm"))
+	baseline = {}
+	if args.baseline.is_file():
+		with open(args.baseline, "r") as f:
+			baseline = json.load(f)
+
+	results = {}
+	regressions = []
+	print(f"{'workload':<20} {'engine':<10} {'instr/s':>12} {'assemble':>9} {'decode':>9} {'execute':>9} {'peak KiB':>9} {'vs base':>8}")
+	for path in workloads:
+		for engine in engines:
+			result = measure(path, engine, args.repeat)
+			result["ips"] = result["steps"] / result["execute"]
+			key = f"{path.stem}/{engine}"
+			results[key] = result
+
+			change = ""
+			if key in baseline:
+				ratio = result["ips"] / baseline[key]["ips"]
+				change = f"{ratio - 1:+.1%}"
+				if ratio < 1 - args.tolerance:
+					regressions.append(key)
+			print(
+				f"{path.stem:<20} {engine:<10} {result['ips']:>12,.0f}"
+				f" {result['assemble'] * 1000:>7.1f}ms {result['decode'] * 1000:>7.1f}ms {result['execute'] * 1000:>7.1f}ms"
+				f" {result['peak_kib']:>9.1f} {change:>8}"
+			)
+
+	if args.save:
+		with open(args.baseline, "w") as f:
+			json.dump(results, f, indent=2)
+		print(f"Saved baseline to {args.baseline}")
+	if regressions:
+		print(f"Regressions: {', '.join(regressions)}")
+		exit(1)
+
+
+if __name__ == "__main__":
+	main()
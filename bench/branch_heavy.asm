@@ -0,0 +1,31 @@
+# Count how often R1 matches R2 as R2 cycles through 0..3, using every
+# kind of conditional branch
+LOAD R1, =0
+LOAD R2, =0
+LOAD R3, =2
+LOAD R4, =0
+LOAD R5, =0
+LOAD R6, =40000
+LOOP:
+BEQ R2, R3, EQUAL
+BLT R2, R3, BELOW
+BGT R2, R3, ABOVE
+EQUAL:
+INC R4
+BR NEXT
+BELOW:
+BLEQ R2, R1, NEXT
+BR NEXT
+ABOVE:
+BGEQ R2, R3, NEXT
+NEXT:
+INC R2
+LOAD R1, =4
+BNEQ R2, R1, SKIPRESET
+LOAD R2, =0
+SKIPRESET:
+LOAD R1, =0
+INC R5
+BLT R5, R6, LOOP
+PRINT R4
+HALT
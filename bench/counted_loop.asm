@@ -0,0 +1,10 @@
+# Long counted loop: sum of 1..200000
+LOAD R1, =0
+LOAD R2, =200000
+LOAD R3, =0
+LOOP:
+INC R1
+ADD R3, R1
+BLT R1, R2, LOOP
+PRINT R3
+HALT
@@ -0,0 +1,21 @@
+# Write 0..4999 to disk, then read it back and sum it, five times over
+LOAD R5, =0
+LOAD R6, =5
+LOAD R2, =5000
+LOAD R4, =0
+PASS:
+LOAD R1, =0
+WRITES:
+WRITE R1, [0, R1]
+INC R1
+BLT R1, R2, WRITES
+LOAD R1, =0
+READS:
+READ R3, [0, R1]
+ADD R4, R3
+INC R1
+BLT R1, R2, READS
+INC R5
+BLT R5, R6, PASS
+PRINT R4
+HALT
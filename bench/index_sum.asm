@@ -0,0 +1,22 @@
+# Fill M[1000..5999] with 0..4999 using index addressing, then sum it
+# back ten times
+LOAD R1, =0
+LOAD R2, =5000
+FILL:
+STORE R1, [1000, R1]
+INC R1
+BLT R1, R2, FILL
+LOAD R4, =0
+LOAD R5, =0
+LOAD R6, =10
+PASS:
+LOAD R1, =0
+SUM:
+LOAD R3, [1000, R1]
+ADD R4, R3
+INC R1
+BLT R1, R2, SUM
+INC R5
+BLT R5, R6, PASS
+PRINT R4
+HALT
@@ -0,0 +1,17 @@
+# Follow pointers with indirect and relative addressing: M[50] points at
+# M[60], which holds the value to accumulate
+LOAD R1, =60
+STORE R1, 50
+LOAD R1, =3
+STORE R1, 60
+LOAD R1, =0
+LOAD R2, =60000
+LOAD R4, =0
+LOOP:
+LOAD R3, @50
+ADD R4, R3
+LOAD R5, $1
+INC R1
+BLT R1, R2, LOOP
+PRINT R4
+HALT
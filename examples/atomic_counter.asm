@@ -0,0 +1,20 @@
+# Every CPU adds 1 to M[90] with FAA and to M[91] with a CAS loop 1000
+# times, so both end up as 1000 times the number of CPUs (see smp.py)
+LOAD R2, =0
+LOAD R3, =1000
+LOOP:
+LOAD R1, =1
+FAA R1, 90
+RETRY:
+LOAD R4, 91
+LOAD R5, 91
+INC R5
+CAS R4, R5, 91
+BNEQ R4, R5, RETRY
+INC R2
+BLT R2, R3, LOOP
+CPUID R6
+PRINT R6
+PRINT 90
+PRINT 91
+HALT
@@ -0,0 +1,26 @@
+# Fills M[60..69] with 3s, copies them to M[70..79], out to the disk and
+# back to M[80..89], then sums and compares the copies. Prints R1 = 0 and
+# R4 = 0 (equal), R3 = 30, R6 = 15 (half the disk copy zeroed) and M[89] = 3
+LOAD R1, =60
+LOAD R2, =3
+LOAD R6, =10
+MFILL R1, R2, R6
+LOAD R2, =70
+MCOPY R2, R1, R6
+MSUM R3, R2, =10
+LOAD R4, =0
+BWRITE R1, R4, R6
+LOAD R5, =50
+DCOPY R5, R4, =10
+LOAD R2, =80
+BREAD R2, R5, R6
+DCMP R4, R5, R6
+DFILL R5, R4, =5
+DSUM R6, R5, =10
+MCMP R1, R2, =10
+PRINT R1
+PRINT R3
+PRINT R4
+PRINT R6
+PRINT 89
+HALT
@@ -0,0 +1,12 @@
+# Counts its runs in disk word 0 and fills the next that many words with
+# the count. Prints R1 = 1 and R3 = 1 on a new disk, and with --disk-file
+# R1 = n and R3 = n * n on the nth run
+READ R1, 0
+INC R1
+WRITE R1, 0
+LOAD R2, =1
+DFILL R2, R1, R1
+DSUM R3, R2, R1
+PRINT R1
+PRINT R3
+HALT
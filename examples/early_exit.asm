@@ -0,0 +1,12 @@
+# Leaves the loop through a branch to the HALT. The last BLT can fall off
+# the end of the program, but never does. Prints R1 = 5
+LOAD R1, =0
+LOAD R2, =5
+BR LOOP
+DONE:
+PRINT R1
+HALT
+LOOP:
+INC R1
+BEQ R1, R2, DONE
+BLT R1, R2, LOOP
@@ -0,0 +1,12 @@
+LOAD R1, =1
+LOAD R2, =3
+BR CHECK
+BODY:
+PRINT R1
+INC R1
+CHECK:
+BLEQ R1, R2, BODY
+BNEQ R1, R2, DONE
+PRINT R2 # never reached
+DONE:
+HALT
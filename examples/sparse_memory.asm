@@ -0,0 +1,18 @@
+# Stores to far apart addresses in the paged address space (--mmu paged),
+# through direct, index and indirect addressing, and reads them back.
+# Prints M[3000] = 7, M[100000] = 12 and R3 = 19
+LOAD R1, =7
+STORE R1, 3000
+LOAD R2, =5
+LOAD R4, =97000
+ADD R2, R1
+STORE R2, [3000, R4]
+LOAD R6, =100000
+STORE R6, 4000
+LOAD R3, @4000
+LOAD R5, 3000
+ADD R3, R5
+PRINT 3000
+PRINT 100000
+PRINT R3
+HALT
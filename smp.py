@@ -0,0 +1,143 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from threading import Lock as ThreadLock
+from time import monotonic
+
+from asm import VM, FlatMMU, Limits, Result, AsmError, ENGINES, DISK_WORD, positive_int
+
+"""
+Runs one program on several CPUs that share main memory and disk. Every
+CPU has its own registers and ip, they all start at address 0, and CPUID
+tells them apart. CAS and FAA are atomic across CPUs. CPUs run in worker
+processes over shared memory, so they use the host's cores, or as
+threads in this process with --threads. Every engine counts each CPU's
+steps, and --max-steps stops each CPU on the same step whichever engine
+runs it.
+
+Usage: smp.py FILE [--cpus N] [--threads] [--engine ENGINE] [--max-steps N] [--memory-size N] [--disk-size N] [--disk-file FILE]
+"""
+
+atomic = None # The lock behind CAS and FAA, handed to worker processes when they start
+
+
+def share_lock(lock):
+	global atomic
+	atomic = lock
+
+
+def words(block: SharedMemory, size: int) -> memoryview:
+	return block.buf[:size * DISK_WORD.itemsize].cast(DISK_WORD.typecode)
+
+
+def run_cpu(cpu: int, program: tuple, memory_name: str, disk_name: str|None, memory_size: int, disk_size: int, disk_file: Path|None, limits: Limits, engine: str) -> Result:
+	# Worker process: attach to the shared memory and run one CPU. A disk
+	# file is mapped by every CPU itself, the mapping is shared anyway.
+	vm = VM(FlatMMU(memory_size), disk_size, disk_file, engine)
+	vm.load(*program)
+	memory_block = SharedMemory(memory_name)
+	disk_block = None if disk_name is None else SharedMemory(disk_name)
+	addresses = words(memory_block, memory_size)
+	disk = None if disk_block is None else words(disk_block, disk_size)
+	vm.memory.share(cpu, atomic, addresses, disk)
+	try:
+		return vm.run(limits, capture=False)
+	finally:
+		vm.close()
+		addresses.release()
+		memory_block.close()
+		if disk_block is not None:
+			disk.release()
+			disk_block.close()
+
+
+def run_processes(program: tuple, cpus: int, limits: Limits, memory_size: int = 100, disk_size: int = 100, disk_file: Path|None = None, engine: str = "interpret") -> tuple[list[Result], list[int]]:
+	# Returns every CPU's result and the final contents of main memory
+	vm = VM(FlatMMU(memory_size), disk_size, disk_file, engine)
+	vm.load(*program)
+	memory_block = SharedMemory(create=True, size=memory_size * DISK_WORD.itemsize)
+	disk_block = None if disk_file is not None else SharedMemory(create=True, size=disk_size * DISK_WORD.itemsize)
+	try:
+		addresses = words(memory_block, memory_size)
+		addresses[:] = vm.memory.addresses
+		if disk_block is not None:
+			disk = words(disk_block, disk_size)
+			disk[:] = vm.memory.disk
+			disk.release()
+		vm.close()
+		disk_name = None if disk_block is None else disk_block.name
+		with ProcessPoolExecutor(cpus, initializer=share_lock, initargs=(Lock(),)) as pool:
+			futures = [
+				pool.submit(run_cpu, cpu, program, memory_block.name, disk_name, memory_size, disk_size, disk_file, limits, engine)
+				for cpu in range(cpus)
+			]
+			results = [future.result() for future in futures]
+		contents = addresses.tolist()
+		addresses.release()
+		return results, contents
+	finally:
+		memory_block.close()
+		memory_block.unlink()
+		if disk_block is not None:
+			disk_block.close()
+			disk_block.unlink()
+
+
+def run_threads(program: tuple, cpus: int, limits: Limits, memory_size: int = 100, disk_size: int = 100, disk_file: Path|None = None, engine: str = "interpret") -> tuple[list[Result], list[int]]:
+	# Same as run_processes, every CPU is a thread sharing the first one's memory
+	lock = ThreadLock()
+	vms = []
+	for cpu in range(cpus):
+		vm = VM(FlatMMU(memory_size), disk_size, disk_file, engine)
+		vm.load(*program)
+		vms.append(vm)
+	shared = vms[0].memory
+	for cpu, vm in enumerate(vms):
+		vm.memory.share(cpu, lock, shared.addresses, shared.disk if disk_file is None else None)
+	with ThreadPoolExecutor(cpus) as pool:
+		results = list(pool.map(lambda vm: vm.run(limits, capture=False), vms))
+	contents = shared.addresses.tolist()
+	for vm in vms:
+		vm.close()
+	return results, contents
+
+
+def main():
+	arg_parser = argparse.ArgumentParser(prog="smp.py")
+	arg_parser.add_argument("filename", type=Path, help="source or object file to run")
+	arg_parser.add_argument("--cpus", type=int, default=2)
+	arg_parser.add_argument("--threads", action="store_true", help="run the CPUs as threads instead of processes")
+	arg_parser.add_argument("--engine", choices=ENGINES, default="interpret")
+	arg_parser.add_argument("--max-steps", type=positive_int, help="instructions per CPU")
+	arg_parser.add_argument("--memory-size", type=int, default=100, help="words of main memory")
+	arg_parser.add_argument("--disk-size", type=int, default=100, help="words of disk")
+	arg_parser.add_argument("--disk-file", type=Path, help="memory map the disk onto this file")
+	args = arg_parser.parse_args()
+
+	vm = VM(FlatMMU(args.memory_size), args.disk_size)
+	try:
+		vm.load_file(args.filename)
+	except AsmError as e:
+		print(e)
+		exit(1)
+	vm.close()
+
+	limits = Limits(args.max_steps)
+	run_cpus = run_threads if args.threads else run_processes
+	start = monotonic()
+	results, _ = run_cpus(vm.program, args.cpus, limits, args.memory_size, args.disk_size, args.disk_file, args.engine)
+	elapsed = monotonic() - start
+	for cpu, result in enumerate(results):
+		registers = ", ".join(f"{name}={value}" for name, value in result.registers.items())
+		print(f"CPU {cpu}: {result.status}, {result.steps} steps, {registers}")
+		if result.error is not None:
+			print(f"CPU {cpu}: {result.error}")
+	steps = sum(result.steps for result in results)
+	print(f"{steps} steps in {elapsed:.2f}s ({steps / elapsed:,.0f} instr/s)")
+	exit(max(result.exit_code for result in results))
+
+
+if __name__ == "__main__":
+	main()
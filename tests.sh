@@ -1,23 +1,155 @@
 #!/usr/bin/env bash
+set -o pipefail
 
 TESTDIR="./examples"
 TOFAIL=("${TESTDIR}/missing_halt.asm")
+# Examples that only run in the paged address space, skipped without --mmu paged
+PAGED=("${TESTDIR}/sparse_memory.asm")
+CONFIGS=("--engine=interpret" "--engine=compile" "--engine=threaded" "--engine=interpret --optimize" "--mmu paged --engine=interpret" "--mmu paged --engine=compile" "--mmu paged --engine=threaded")
+# Every example is also stopped after each of these many steps and
+# resumed from a checkpoint
+CHECKPOINT_CONFIGS=("--engine=interpret" "--engine=threaded" "--engine=interpret --optimize" "--mmu paged --engine=interpret" "--mmu paged --engine=threaded")
+CHECKPOINT_STEPS=(1 3 17 200)
+CHECKPOINT="$(mktemp)"
+OUTPUT="$(mktemp)"
+SCRATCH="$(mktemp -d)" # files the tests below write
+trap 'rm -rf "${CHECKPOINT}" "${OUTPUT}" "${SCRATCH}"' EXIT
 
-for filename in ${TESTDIR}/*; do
-	if [[ ${TOFAIL[@]} =~ $filename ]]; then
-		if python3 asm.py $filename > /dev/null
+# Drops what asm.py reports about the run itself, leaving the program's output
+program_output() {
+	grep -v -e "^Step limit reached" -e "^Optimizer: " || true
+}
+
+# Reports whether OUTPUT matches the expected output file
+compare() {
+	if cmp -s "${OUTPUT}" "$2"
+	then
+		echo "$1: success"
+	else
+		echo "$1: failed"
+	fi
+}
+
+# The output must match ${filename%.asm}.out, and the exit status must
+# be an error only for the programs in TOFAIL
+for config in "${CONFIGS[@]}"; do
+	for filename in ${TESTDIR}/*.asm; do
+		if [[ ${PAGED[@]} =~ $filename && $config != *--mmu\ paged* ]]; then
+			continue
+		fi
+		python3 asm.py $config $filename | program_output > "${OUTPUT}"
+		status=$?
+		if [[ ${TOFAIL[@]} =~ $filename ]]; then
+			[[ $status -ne 0 ]]
+		else
+			[[ $status -eq 0 ]]
+		fi
+		if [[ $? -eq 0 ]] && cmp -s "${OUTPUT}" "${filename%.asm}.out"
 		then
-			echo "${filename}: failed"
+			echo "${filename} (${config}): success"
 		else
-			echo "${filename}: success"
+			echo "${filename} (${config}): failed"
 		fi
-	else
-		if python3 asm.py $filename > /dev/null
+	done
+done
+
+# The output before the stop and after resuming must add up to the output
+# of a run straight through. A program that halts first leaves no checkpoint.
+for config in "${CHECKPOINT_CONFIGS[@]}"; do
+	for filename in ${TESTDIR}/*.asm; do
+		if [[ ${TOFAIL[@]} =~ $filename ]] || [[ ${PAGED[@]} =~ $filename && $config != *--mmu\ paged* ]]; then
+			continue
+		fi
+		failed=0
+		for steps in "${CHECKPOINT_STEPS[@]}"; do
+			rm -f "${CHECKPOINT}"
+			python3 asm.py $config --clock simulated --max-steps $steps --checkpoint "${CHECKPOINT}" $filename | program_output > "${OUTPUT}"
+			if [[ -s "${CHECKPOINT}" ]] && ! python3 asm.py $config --clock simulated "${CHECKPOINT}" | program_output >> "${OUTPUT}"; then
+				failed=1
+			fi
+			if ! cmp -s "${OUTPUT}" "${filename%.asm}.out"; then
+				failed=1
+			fi
+		done
+		if [[ $failed -eq 0 ]]
 		then
-			echo "${filename}: success"
+			echo "${filename} (${config}, checkpoint): success"
 		else
-			echo "${filename}: failed"
+			echo "${filename} (${config}, checkpoint): failed"
 		fi
-	fi
+	done
+done
 
+# Three CPUs add to atomic_counter.asm's two counters at once, as processes
+# and as threads. The CPU that finishes last prints them both at 3000.
+largest() {
+	grep "^$1: " "${OUTPUT}" | cut -d " " -f 2 | sort -n | tail -n 1
+}
+for engine in interpret compile threaded; do
+	for mode in "" "--threads"; do
+		python3 smp.py --cpus 3 $mode --engine=$engine ${TESTDIR}/atomic_counter.asm > "${OUTPUT}"
+		if [[ $? -eq 0 ]] && [[ $(largest "M\[90\]") == 3000 ]] && [[ $(largest "M\[91\]") == 3000 ]]
+		then
+			echo "smp.py atomic_counter.asm (--cpus 3${mode:+ $mode} --engine=${engine}): success"
+		else
+			echo "smp.py atomic_counter.asm (--cpus 3${mode:+ $mode} --engine=${engine}): failed"
+		fi
+	done
 done
+
+# A trace of block_memory.asm, read back by asmtrace.py, and the last
+# few steps of it kept by --trace-ring
+{
+	python3 asm.py --trace "${SCRATCH}/trace" ${TESTDIR}/block_memory.asm
+	python3 asmtrace.py summary "${SCRATCH}/trace"
+	python3 asmtrace.py show "${SCRATCH}/trace" --from 6 --to 9
+	python3 asmtrace.py show "${SCRATCH}/trace" --address 75
+	python3 asmtrace.py show "${SCRATCH}/trace" --register R6
+	python3 asmtrace.py replay "${SCRATCH}/trace" 12
+	python3 asm.py --trace "${SCRATCH}/trace" --trace-ring 4 ${TESTDIR}/block_memory.asm > /dev/null
+	python3 asmtrace.py show "${SCRATCH}/trace"
+} > "${OUTPUT}"
+compare "asmtrace.py block_memory.asm" "${TESTDIR}/block_memory.trace.out"
+
+# asmdebug.py steps block_memory.asm forwards, goes back past a snapshot
+# and checks memory is as it was, then runs to the end and steps back
+printf "s 5\nr\nm 60 3\ng 12\nr\nd 0 3\nb 4\nr\nm 70 2\ng 20\nc\nb 2\nr\nq\n" | python3 asmdebug.py --interval 4 ${TESTDIR}/block_memory.asm > "${OUTPUT}"
+compare "asmdebug.py block_memory.asm" "${TESTDIR}/block_memory.debug.out"
+
+# batch.py --async runs slow_loop.asm, loop.asm and disk_io.asm together on
+# one event loop. With the real clock slow_loop's SKIPs wait on the async
+# clock without holding up the others, which finish well inside its
+# three seconds. With the simulated clock they only advance virtual time.
+for filename in slow_loop.asm loop.asm disk_io.asm; do
+	echo "$(pwd)/${TESTDIR}/${filename}"
+done > "${SCRATCH}/manifest"
+{
+	for clock in real simulated; do
+		python3 batch.py "${SCRATCH}/manifest" --async --quantum 3 --clock $clock -o "${SCRATCH}/results.jsonl"
+		python3 -c '
+import json, sys
+for line in open(sys.argv[1]):
+	result = json.loads(line)
+	name = result["path"].rsplit("/", 1)[1]
+	waited = "waited" if result["wall_time"] > 1 else "no wait"
+	print(name, result["status"], result["steps"], "steps", result["virtual_time"], "virtual seconds,", waited)
+	print(result["stdout"], end="")
+' "${SCRATCH}/results.jsonl"
+	done
+} > "${OUTPUT}"
+compare "batch.py --async" "${TESTDIR}/async.out"
+
+# The --profile report of forward_branch.asm, which has a loop entered at
+# its condition and a branch that is always taken, and its JSON form
+{
+	python3 asm.py --profile --profile-out "${SCRATCH}/profile.json" ${TESTDIR}/forward_branch.asm
+	cat "${SCRATCH}/profile.json"
+} > "${OUTPUT}"
+compare "asm.py --profile forward_branch.asm" "${TESTDIR}/forward_branch.profile.out"
+
+# disk_counter.asm run five times over one --disk-file, by every engine,
+# has to find what the run before it wrote
+for config in "--engine=interpret" "--engine=compile" "--engine=threaded" "--engine=interpret --optimize" "--mmu paged --engine=interpret"; do
+	python3 asm.py $config --disk-file "${SCRATCH}/disk" ${TESTDIR}/disk_counter.asm | program_output
+done > "${OUTPUT}"
+compare "asm.py --disk-file disk_counter.asm" "${TESTDIR}/disk_counter.disk.out"